@@ -1,21 +1,161 @@
+import argparse
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy
 import wrds
 from pathlib import Path
 import yaml
-from scipy.stats.mstats import winsorize
 import numpy as np
 
+from analysis import winsorize
+from dataset import load_sample, save_sample
+from histogram_cube import HistogramCube
+from profiling import span, start_trace
+
+# rows of the two I/B/E/S tables used for Degeorge et al. (1999)
+STATSUM_FILTER = ("where fpi='6' "
+                  "and measure='EPS' "
+                  "and curcode='USD' "
+                  "and curr_act ='USD' "
+                  "and actual is not null "
+                  "and medest is not null "
+                  "and meanest is not null "
+                  "and ticker is not null "
+                  "and statpers is not null "
+                  "and anndats_act is not null")
+ACTPSUM_FILTER = ("where measure='EPS' "
+                  "and ticker is not null "
+                  "and statpers is not null "
+                  "and curcode='USD' "
+                  "and curr_price ='USD' "
+                  "and price is not null")
+
+# the only columns of the two tables that prep_data uses
+STATSUM_COLUMNS = ['ticker', 'statpers', 'fpedats', 'anndats_act', 'actual', 'meanest']
+ACTPSUM_COLUMNS = ['ticker', 'statpers', 'price']
+
+# columns, date columns and folder of the streamed extract of each I/B/E/S table
+EXTRACTS = {'statsum_epsus': (STATSUM_COLUMNS, ['statpers', 'fpedats', 'anndats_act'], 'dataPrep/ibes_statsum_USD'),
+            'actpsum_epsus': (ACTPSUM_COLUMNS, ['statpers'], 'dataPrep/ibes_actpsum_USD')}
+
+# latest statpers of each streamed table
+HIGH_WATER_MARKS = 'dataPrep/high_water_marks.json'
+
+# columns of the I/B/E/S tables that are not part of the sample
+UNNEEDED_COLUMNS = ['cusip_x', 'oftic_x', 'cname_x', 'statpers', 'measure_x', 'fy0a',
+                    'curcode_x', 'fvyrgro', 'fvyrsta', 'usfirm_x', 'fy0edats', 'int0a',
+                    'int0dats', 'prdays', 'shout', 'iadiv', 'curr_price',
+                    'cusip_y', 'oftic_y', 'cname_y', 'measure_y', 'fiscalp', 'fpi',
+                    'estflag', 'curcode_y', 'numest', 'numup', 'numdown', 'medest',
+                    'meanest', 'stdev', 'highest', 'lowest', 'usfirm_y', 'actual',
+                    'actdats_act', 'acttims_act', 'anndats_act', 'anntims_act', 'curr_act', 'fpeq']
+
+# compact dtypes of the I/B/E/S extracts: categorical strings and small integer flags
+EXTRACT_DTYPES = {'ticker': 'category', 'cusip': 'category', 'oftic': 'category', 'cname': 'category',
+                  'measure': 'category', 'fiscalp': 'category', 'fpi': 'category', 'estflag': 'category',
+                  'curcode': 'category', 'curr_act': 'category', 'curr_price': 'category',
+                  'numest': 'int16', 'numup': 'int16', 'numdown': 'int16', 'usfirm': 'int8'}
+
+# compact dtypes of the sample: the variables in cents are single precision
+SAMPLE_DTYPES = {'year': 'int16', 'eps_n': 'float32', 'ferr_n': 'float32', 'cheps_n': 'float32'}
+
 # create some folders
 Path('input').mkdir(exist_ok=True)
 Path('dataPrep').mkdir(exist_ok=True)
 
 
-def prep_data():
+def prior_year_eps(tickers, fpeq, actual) -> np.ndarray:
     """
-    :return: dataframe sample ready for Degeorge et al. (1999)
+    matches every fiscal period with the closest of the four previous periods of the same ticker
+    that ended 355 to 374 days earlier, using one sorted search instead of shifting and joining each lag.
+
+    :param tickers: ticker (or ticker code) of each fiscal period, sorted by ticker and fiscal period end
+    :param fpeq: fiscal period end dates, sorted within each ticker
+    :param actual: actual EPS of each fiscal period
+    :return: actual EPS of the matched period a year earlier (NaN if there is none)
+    """
+    codes = pd.factorize(np.asarray(tickers))[0].astype(np.int64)
+    days = pd.to_datetime(np.asarray(fpeq)).to_numpy().astype('datetime64[D]').astype(np.int64)
+    actual = np.asarray(actual, dtype=float)
+
+    # sorted keys of (ticker, fiscal period end), so a search never crosses into another ticker unnoticed
+    days = days - days.min()
+    keys = codes * (days.max() + 1) + days
+
+    # latest period of the ticker that ended at least 355 days before
+    candidate = np.searchsorted(keys, keys - 355, side='right') - 1
+
+    prior_year = np.full(len(keys), np.nan)
+    pending = np.arange(len(keys))
+    while len(pending):
+        matched = candidate[pending]
+        keep = (matched >= 0) & (pending - matched <= 4)
+        pending, matched = pending[keep], matched[keep]
+        keep = (codes[matched] == codes[pending]) & (days[pending] - days[matched] < 375)
+        pending, matched = pending[keep], matched[keep]
+
+        # periods without an actual EPS are skipped in favour of the next earlier one
+        found = ~np.isnan(actual[matched])
+        prior_year[pending[found]] = actual[matched[found]]
+        pending = pending[~found]
+        candidate[pending] -= 1
+
+    return prior_year
+
+
+def load_extract(name: str, streamed: bool = False, tickers: set = None) -> pd.DataFrame:
+    """
+    :param name: ibes_statsum_USD or ibes_actpsum_USD
+    :param streamed: load the table saved by the streaming download (partitioned parquet)
+    instead of the one saved by the full download (compressed pickle)
+    :param tickers: only load the rows of these tickers (all of them if None)
+    :return: the table
+    """
+    if streamed:
+        filters = None if tickers is None else [('ticker', 'in', list(tickers))]
+        df = pd.read_parquet(Path('dataPrep', name), filters=filters, read_dictionary=['ticker'])
+        return compact_extract(df.drop(columns=['statpers_year']))
+    df = compact_extract(pd.read_pickle(f'dataPrep/{name}.pkl.gz'))
+    return df if tickers is None else df[df['ticker'].isin(tickers)]
+
+
+def compact_extract(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    :return: df with the dtypes of EXTRACT_DTYPES for the columns it has and datetime dates
+    """
+    df = df.astype({column: dtype for column, dtype in EXTRACT_DTYPES.items() if column in df.columns})
+    for date in ['statpers', 'fpedats', 'actdats_act', 'anndats_act', 'fy0edats', 'int0dats', 'prdays']:
+        if date in df.columns and df[date].dtype == object:
+            df[date] = pd.to_datetime(df[date])
+    return df
+
+
+def _categorize_tickers(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    :return: df (indexed by ticker and fiscal period end) with categorical tickers,
+    the categories are the sorted tickers of df, whichever partitions it was put together from
+    """
+    tickers = pd.Categorical(np.asarray(df.index.get_level_values('ticker')))
+    df.index = pd.MultiIndex.from_arrays([tickers, df.index.get_level_values('fpedats')], names=['ticker', 'fpedats'])
+    return df
+
+
+def derive_sample(df_ibes_sumstat: pd.DataFrame, df_ibes_actpsum: pd.DataFrame) -> pd.DataFrame:
+    """
+    everything in the sample but the winsorized variables, each ticker is derived from its own rows only.
+
+    :return: unwinsorized sample indexed by ticker and fiscal period end
     """
-    df_ibes_sumstat = pd.read_pickle('dataPrep/ibes_statsum_USD.pkl.gz')
-    df_ibes_actpsum = pd.read_pickle('dataPrep/ibes_actpsum_USD.pkl.gz')
+    # both tables share the same (sorted) ticker categories, so the merge and sorts work on the codes
+    # (set_categories, as astype is a no-op for the same categories in another order)
+    tickers = df_ibes_actpsum['ticker'].cat.categories.union(df_ibes_sumstat['ticker'].cat.categories).sort_values()
+    df_ibes_actpsum = df_ibes_actpsum.assign(ticker=df_ibes_actpsum['ticker'].cat.set_categories(tickers))
+    df_ibes_sumstat = df_ibes_sumstat.assign(ticker=df_ibes_sumstat['ticker'].cat.set_categories(tickers))
 
     df = df_ibes_actpsum.merge(df_ibes_sumstat, how='inner', on=['ticker', 'statpers'])
     df['year'] = pd.DatetimeIndex(df['anndats_act']).year
@@ -28,67 +168,128 @@ def prep_data():
     df.reset_index(drop=True, inplace=True)
     df.sort_values(by=['ticker', 'fpedats'], inplace=True)
     df.set_index(['ticker', 'fpedats'], inplace=True)
-    df['prior_year_EPS'] = np.nan
-
-    for i in range(1, 5):
-        lag_fpeq = df['fpeq'].groupby(level=["ticker"]).shift(i)
-        lag_actual = df['actual'].groupby(level=["ticker"]).shift(i)
-        df = df.join(lag_fpeq, rsuffix='_l')
-        df = df.join(lag_actual, rsuffix='_l')
-        df['diff'] = df['fpeq'] - df['fpeq_l']
-        df['diff'] = df['diff'].dt.days
-        df.loc[(df['diff'] >= 355) & (df['diff'] < 375), 'one_year_agp'] = df['actual_l']
-        df['prior_year_EPS'].fillna(df['one_year_agp'], inplace=True)
-        df = df.drop(columns=['fpeq_l', 'actual_l', 'one_year_agp', 'diff'])
+    df = _categorize_tickers(df)
+    df['prior_year_EPS'] = prior_year_eps(df.index.get_level_values('ticker').codes, df['fpeq'], df['actual'])
 
     df['eps_n'] = df['actual'] * 100
     df['ferr_n'] = (df['actual'] - df['meanest']) * 100
     df['cheps_n'] = (df['actual'] - df['prior_year_EPS']) * 100
 
-    # winsorize variables
+    return df.astype(SAMPLE_DTYPES)
+
+
+def winsorize_sample(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    adds the winsorized (1%, 99%) variables, the bounds are computed over the whole sample.
+
+    :return: df with eps_w, ferr_w and cheps_w (single precision, like the unwinsorized ones)
+    """
     for column in ['eps_n', 'ferr_n', 'cheps_n']:
         column_name = column.split("_")[0]
-        df[f'{column_name}_w'] = winsorize(df[f'{column_name}_n'], limits=[.01, .01])
+        df[f'{column_name}_w'] = winsorize(df[f'{column_name}_n'].to_numpy(), limits=(.01, .01)).astype(np.float32)
 
     return df
 
 
-if __name__ == '__main__':
-    # establish a connection to WRDS Server (requires .pgpass)
-    db = wrds.Connection(wrds_username=yaml.safe_load(open('.secrets.yaml'))['wrds'])
+def derive_sample_parallel(df_ibes_sumstat: pd.DataFrame, df_ibes_actpsum: pd.DataFrame,
+                           workers: int) -> pd.DataFrame:
+    """
+    derive_sample with the tickers hash-partitioned across a pool of processes.
+    the partitions are put back in the order of the serial build, so the result is identical.
+
+    :param workers: number of processes
+    :return: unwinsorized sample indexed by ticker and fiscal period end
+    """
+    partitions = [(sumstat, actpsum) for sumstat, actpsum in zip(_ticker_partitions(df_ibes_sumstat, workers),
+                                                                 _ticker_partitions(df_ibes_actpsum, workers))
+                  if len(sumstat) and len(actpsum)]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(derive_sample, *zip(*partitions)))
+
+    return _categorize_tickers(pd.concat(parts).sort_index(level=['ticker', 'fpedats'], sort_remaining=False))
+
+
+def _ticker_partitions(df: pd.DataFrame, partitions: int) -> list:
+    """
+    :return: rows of df split by a (stable across processes) hash of their ticker
+    """
+    tickers = df['ticker'].cat
+    partition = (pd.util.hash_array(np.asarray(tickers.categories)) % partitions)[tickers.codes]
+    return [df[partition == number] for number in range(partitions)]
+
+
+def prep_data(workers: int = 1, streamed: bool = False):
+    """
+    :param workers: number of processes deriving the sample, the tickers are split between them
+    :param streamed: build the sample from the streaming download instead of the full download
+    :return: dataframe sample ready for Degeorge et al. (1999)
+    """
+    with span('load_extract', table='ibes_statsum_USD', streamed=streamed):
+        df_ibes_sumstat = load_extract('ibes_statsum_USD', streamed)
+    with span('load_extract', table='ibes_actpsum_USD', streamed=streamed):
+        df_ibes_actpsum = load_extract('ibes_actpsum_USD', streamed)
+
+    with span('derive_sample', workers=workers):
+        if workers > 1:
+            df = derive_sample_parallel(df_ibes_sumstat, df_ibes_actpsum, workers)
+        else:
+            df = derive_sample(df_ibes_sumstat, df_ibes_actpsum)
+
+    # winsorize variables
+    with span('winsorize_sample'):
+        return winsorize_sample(df)
+
+
+def refresh_sample(previous: pd.DataFrame, tickers: set) -> pd.DataFrame:
+    """
+    rebuilds only the tickers with new rows in the extract and keeps the rest of the previous sample,
+    then refreshes the winsorization bounds over the whole sample.
+
+    :param previous: the sample saved by the last build
+    :param tickers: tickers with new, changed or removed rows in the extract
+    :return: dataframe sample ready for Degeorge et al. (1999)
+    """
+    unchanged = previous[~previous.index.get_level_values('ticker').isin(tickers)]
+    unchanged = unchanged.drop(columns=['eps_w', 'ferr_w', 'cheps_w'])
+
+    changed = derive_sample(load_extract('ibes_statsum_USD', True, tickers),
+                            load_extract('ibes_actpsum_USD', True, tickers))
+    changed = changed.drop(columns=UNNEEDED_COLUMNS, errors='ignore')[unchanged.columns]
+
+    df = pd.concat([unchanged, changed]).sort_index(level=['ticker', 'fpedats'], sort_remaining=False)
+    return winsorize_sample(_categorize_tickers(df))
+
+
+def download_tables(db) -> None:
+    """
+    downloads every column of the two I/B/E/S tables in one query each and saves them as compressed pickles.
+    any earlier streaming download is removed, so an incremental refresh cannot build on it.
+
+    :param db: connection to the WRDS server
+    """
+    for _, _, path in EXTRACTS.values():
+        shutil.rmtree(path, ignore_errors=True)
+    Path(HIGH_WATER_MARKS).unlink(missing_ok=True)
+
     db.list_tables(library='ibes')
 
     # I/B/E/S Summary History - Summary Statistics with Actuals (EPS for US Region)
     ibes_statsum_description = db.describe_table(library='ibes', table='statsum_epsus')
-    ibes_statsum_USD = db.raw_sql("select * from ibes.statsum_epsus  "
-                                  "where fpi='6' "
-                                  "and measure='EPS' "
-                                  "and curcode='USD' "
-                                  "and curr_act ='USD'"
-                                  "and actual is not null "
-                                  "and medest is not null "
-                                  "and meanest is not null "
-                                  "and ticker is not null "
-                                  "and statpers is not null "
-                                  "and anndats_act is not null;")
+    ibes_statsum_USD = db.raw_sql(f"select * from ibes.statsum_epsus {STATSUM_FILTER};")
 
     ibes_statsum_USD = pd.DataFrame(ibes_statsum_USD)
 
     # fix the date formatting for all the date columns
     for date in ['statpers', 'fpedats', 'actdats_act', 'anndats_act']:
-        ibes_statsum_USD[f'{date}1'] = pd.to_datetime(ibes_statsum_USD[f'{date}'], infer_datetime_format=True).dt.date
-        ibes_statsum_USD[f'{date}'] = ibes_statsum_USD[f'{date}1']
-        ibes_statsum_USD.drop(columns=[f'{date}1'], inplace=True)
+        ibes_statsum_USD[f'{date}'] = pd.to_datetime(ibes_statsum_USD[f'{date}'], infer_datetime_format=True)
 
-    # fix the time formatting for all the time columns
+    # fix the time formatting for all the time columns (seconds after midnight, as time offsets)
     for time_var in ['acttims_act', 'anntims_act']:
-        ibes_statsum_USD[f'{time_var}1'] = \
-            ibes_statsum_USD[f'{time_var}'].apply(lambda x: pd.Timestamp(x, unit='s').time())
-        ibes_statsum_USD[f'{time_var}'] = ibes_statsum_USD[f'{time_var}1']
-        ibes_statsum_USD.drop(columns=[f'{time_var}1'], inplace=True)
+        ibes_statsum_USD[f'{time_var}'] = pd.to_timedelta(ibes_statsum_USD[f'{time_var}'], unit='s')
 
-    # convert some float to int
-    ibes_statsum_USD = ibes_statsum_USD.astype({'numest': 'int', 'numup': 'int', 'numdown': 'int', 'usfirm': 'int'})
+    # categorical strings and small integer flags
+    ibes_statsum_USD = compact_extract(ibes_statsum_USD)
 
     head_ibes_statsum_USD = ibes_statsum_USD.head(50)
 
@@ -98,38 +299,209 @@ if __name__ == '__main__':
     # I/B/E/S Summary History - Actuals + Pricing and Ancillary File (EPS for US Region)
     ibes_actpsum_description = db.describe_table(library='ibes', table='actpsum_epsus')
 
-    ibes_actpsum_USD = db.raw_sql("select * from ibes.actpsum_epsus  "
-                                  "where measure='EPS' "
-                                  "and ticker is not null "
-                                  "and statpers is not null "
-                                  "and curcode='USD' "
-                                  "and curr_price ='USD' "
-                                  "and price is not null;")
+    ibes_actpsum_USD = db.raw_sql(f"select * from ibes.actpsum_epsus {ACTPSUM_FILTER};")
 
     # fix the date formatting for all the date columns
     for date in ['statpers', 'fy0edats', 'int0dats', 'prdays']:
-        ibes_actpsum_USD[f'{date}1'] = pd.to_datetime(ibes_actpsum_USD[f'{date}'], infer_datetime_format=True).dt.date
-        ibes_actpsum_USD[f'{date}'] = ibes_actpsum_USD[f'{date}1']
-        ibes_actpsum_USD.drop(columns=[f'{date}1'], inplace=True)
+        ibes_actpsum_USD[f'{date}'] = pd.to_datetime(ibes_actpsum_USD[f'{date}'], infer_datetime_format=True)
 
-    # convert some float to int
-    ibes_actpsum_USD = ibes_actpsum_USD.astype({'usfirm': 'int'})
+    # categorical strings and small integer flags
+    ibes_actpsum_USD = compact_extract(ibes_actpsum_USD)
 
     head_ibes_actpsum_USD = ibes_actpsum_USD.head(50)
 
     ibes_actpsum_USD.to_pickle('dataPrep/ibes_actpsum_USD.pkl.gz')
 
-    # create database for Degeorge et al. (1999)
-    df = prep_data()
 
-    # drop unneeded variables
-    sample = df.drop(columns=['cusip_x', 'oftic_x', 'cname_x', 'statpers', 'measure_x', 'fy0a',
-                              'curcode_x', 'fvyrgro', 'fvyrsta', 'usfirm_x', 'fy0edats', 'int0a',
-                              'int0dats', 'prdays', 'shout', 'iadiv', 'curr_price',
-                              'cusip_y', 'oftic_y', 'cname_y', 'measure_y', 'fiscalp', 'fpi',
-                              'estflag', 'curcode_y', 'numest', 'numup', 'numdown', 'medest',
-                              'meanest', 'stdev', 'highest', 'lowest', 'usfirm_y', 'actual',
-                              'actdats_act', 'acttims_act', 'anndats_act', 'anntims_act', 'curr_act', 'fpeq'])
+def stream_table(connection, table: str, columns: list, dates: list, path: str, chunksize: int) -> str:
+    """
+    downloads only the given columns of an I/B/E/S table in chunks and appends every chunk to
+    parquet files partitioned by the year of statpers, so memory is bounded by the chunk size.
+
+    :param connection: SQLAlchemy connection to WRDS or to a local copy of the ibes tables
+    :param table: statsum_epsus or actpsum_epsus
+    :param columns: columns to download
+    :param dates: date columns among them
+    :param path: folder of the partitioned files, replaced if it exists
+    :param chunksize: number of rows per chunk
+    :return: latest statpers downloaded (the high-water mark of the table)
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    row_filter = STATSUM_FILTER if table == 'statsum_epsus' else ACTPSUM_FILTER
+    query = f"select {', '.join(columns)} from ibes.{table} {row_filter}"
+
+    high_water_mark = pd.Timestamp.min
+    for chunk in pd.read_sql(query, connection, chunksize=chunksize):
+        _write_partitions(_format_chunk(chunk, dates), columns, dates, path)
+        high_water_mark = max(high_water_mark, chunk['statpers'].max())
+
+    return str(high_water_mark.date())
+
+
+def refresh_table(connection, table: str, columns: list, dates: list, path: str, chunksize: int,
+                  high_water_mark: str) -> tuple:
+    """
+    downloads the rows of an I/B/E/S table from the high-water mark on (the last month may have been
+    incomplete) and replaces the rows from that month on in the partitioned files.
+
+    :param connection: SQLAlchemy connection to WRDS or to a local copy of the ibes tables
+    :param table: statsum_epsus or actpsum_epsus
+    :param columns: columns to download
+    :param dates: date columns among them
+    :param path: folder of the partitioned files written by stream_table
+    :param chunksize: number of rows per chunk
+    :param high_water_mark: latest statpers of the previous download
+    :return: new high-water mark and the tickers with new, changed or removed rows
+    """
+    row_filter = STATSUM_FILTER if table == 'statsum_epsus' else ACTPSUM_FILTER
+    query = f"select {', '.join(columns)} from ibes.{table} {row_filter} and statpers >= '{high_water_mark}'"
+    chunks = [_format_chunk(chunk, dates) for chunk in pd.read_sql(query, connection, chunksize=chunksize)]
+    new_rows = pd.concat(chunks) if chunks else \
+        _format_chunk(pd.DataFrame({column: [] for column in columns}), dates)
+
+    # every partition that has (or gets) rows from the high-water mark on is rewritten
+    mark = pd.Timestamp(high_water_mark)
+    tickers = set(new_rows['ticker'])
+    years = set(new_rows['statpers_year']) | {int(partition.name.split('=')[1])
+                                              for partition in Path(path).glob('statpers_year=*')}
+    for year in sorted(year for year in years if year >= mark.year):
+        partition = Path(path, f'statpers_year={year}')
+        kept = pd.read_parquet(partition) if partition.is_dir() else new_rows[columns].iloc[:0]
+        tickers |= set(kept.loc[kept['statpers'] >= mark, 'ticker'])
+        kept = kept[kept['statpers'] < mark].assign(statpers_year=year)
+
+        shutil.rmtree(partition, ignore_errors=True)
+        _write_partitions(pd.concat([kept, new_rows[new_rows['statpers_year'] == year]]), columns, dates, path)
+
+    return str(max(mark, new_rows['statpers'].max()).date()) if len(new_rows) else high_water_mark, tickers
+
+
+def stream_tables(connection, chunksize: int) -> None:
+    """
+    streams the columns of the two I/B/E/S tables that prep_data uses into dataPrep
+    and records the high-water mark of each table.
+
+    :param connection: SQLAlchemy connection to WRDS or to a local copy of the ibes tables
+    :param chunksize: number of rows per chunk
+    """
+    high_water_marks = {table: stream_table(connection, table, columns, dates, path, chunksize)
+                        for table, (columns, dates, path) in EXTRACTS.items()}
+    Path(HIGH_WATER_MARKS).write_text(json.dumps(high_water_marks, indent=2))
+
+
+def refresh_tables(connection, chunksize: int) -> set:
+    """
+    fetches the rows of the two I/B/E/S tables past their high-water marks into dataPrep.
+
+    :param connection: SQLAlchemy connection to WRDS or to a local copy of the ibes tables
+    :param chunksize: number of rows per chunk
+    :return: tickers with new, changed or removed rows in either table
+    """
+    high_water_marks = json.loads(Path(HIGH_WATER_MARKS).read_text())
+    tickers = set()
+    for table, (columns, dates, path) in EXTRACTS.items():
+        high_water_marks[table], changed = refresh_table(connection, table, columns, dates, path, chunksize,
+                                                         high_water_marks[table])
+        tickers |= changed
+    Path(HIGH_WATER_MARKS).write_text(json.dumps(high_water_marks, indent=2))
+    return tickers
+
+
+def connect_database(url: str):
+    """
+    :param url: SQLAlchemy URL of a local PostgreSQL or SQLite copy of the ibes tables
+    :return: connection that streams query results from the server
+    """
+    engine = sqlalchemy.create_engine(url)
+    connection = engine.connect()
+    if engine.dialect.name == 'sqlite':
+        # the queries name the tables as ibes.<table>, as on WRDS
+        connection.exec_driver_sql(f"attach database '{engine.url.database}' as ibes")
+    return connection.execution_options(stream_results=True)
+
+
+def _format_chunk(chunk: pd.DataFrame, dates: list) -> pd.DataFrame:
+    """
+    :return: chunk with its date columns as datetimes and the year of statpers (the partition)
+    """
+    for date in dates:
+        chunk[date] = pd.to_datetime(chunk[date])
+    chunk['statpers_year'] = chunk['statpers'].dt.year
+    return chunk
+
+
+def _write_partitions(chunk: pd.DataFrame, columns: list, dates: list, path: str) -> None:
+    """
+    appends the rows of chunk to the parquet files of their year of statpers.
+    the schema is fixed so that chunks with only missing values still match.
+    """
+    fields = [(column, pa.string() if column == 'ticker' else pa.timestamp('ns') if column in dates else pa.float64())
+              for column in columns]
+    schema = pa.schema(fields + [('statpers_year', pa.int32())])
+    pq.write_to_dataset(pa.Table.from_pandas(chunk[columns + ['statpers_year']], schema=schema, preserve_index=False),
+                        root_path=path, partition_cols=['statpers_year'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download I/B/E/S and create the sample for Degeorge et al. (1999).')
+    parser.add_argument('--streaming', action='store_true',
+                        help='download only the columns prep_data uses, in chunks, into year-partitioned files')
+    parser.add_argument('--chunksize', type=int, default=500_000,
+                        help='rows per chunk of the streaming download')
+    parser.add_argument('--database',
+                        help='SQLAlchemy URL of a local PostgreSQL/SQLite copy of the ibes tables to stream from '
+                             'instead of WRDS')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch the rows past the high-water mark of the last streaming download '
+                             'and only rebuild the tickers that have new rows')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes building the sample (the tickers are split between them)')
+    args = parser.parse_args()
+
+    if args.incremental and not Path(HIGH_WATER_MARKS).exists():
+        parser.error('--incremental needs a previous streaming download')
+
+    if args.database:
+        connection = connect_database(args.database)
+    else:
+        # establish a connection to WRDS Server (requires .pgpass)
+        db = wrds.Connection(wrds_username=yaml.safe_load(open('.secrets.yaml'))['wrds'])
+        connection = db.engine.connect().execution_options(stream_results=True)
+
+    # timing (and memory) spans of every stage of the build, when profiling is on
+    start_trace('build')
+
+    if args.incremental:
+        # only fetch the new rows and only rebuild the tickers that have some
+        with span('refresh_tables'):
+            tickers = refresh_tables(connection, args.chunksize)
+        with span('refresh_sample', tickers=len(tickers)):
+            df = refresh_sample(pd.read_pickle('input/data.pkl.gz'), tickers)
+
+    else:
+        if args.streaming or args.database:
+            with span('stream_tables'):
+                stream_tables(connection, args.chunksize)
+        else:
+            with span('download_tables'):
+                download_tables(db)
+
+        # create database for Degeorge et al. (1999)
+        with span('prep_data'):
+            df = prep_data(workers=args.workers, streamed=args.streaming or args.database is not None)
+
+    # drop unneeded variables (the streaming download never had most of them)
+    sample = df.drop(columns=UNNEEDED_COLUMNS, errors='ignore')
 
     # save the data as a compressed pickle file
-    sample.to_pickle('input/data.pkl.gz')
+    with span('save_pickle', rows=len(sample)):
+        sample.to_pickle('input/data.pkl.gz')
+
+    # save the data as an uncompressed Arrow IPC (feather) file sorted by year and price,
+    # so the dashboard can memory-map it and read only the columns it needs, as they are
+    with span('save_feather', rows=len(sample)):
+        save_sample(sample)
+
+    # precompute the prefix sums of the histograms of Figures 5 to 7 by year and price bucket
+    with span('build_cube'):
+        HistogramCube.build(load_sample()).save('input/histogram_cube')
@@ -0,0 +1,324 @@
+import numpy as np
+
+from profiling import span
+
+
+def centile_statistics(price_percentiles: np.ndarray, variables: dict) -> dict:
+    """
+    median, 25th and 75th percentiles and interquartile range of each variable by centile of price,
+    computed from one sort of each variable (grouped by centile) instead of separate groupbys.
+    missing values are skipped and quantiles are linearly interpolated, the same as pandas.
+
+    :param price_percentiles: centile of price of each observation
+    :param variables: arrays of eps, ferr and cheps aligned with price_percentiles
+    :return: arrays keyed by 'price_percentiles', each variable (median), '<variable>_P25',
+    '<variable>_P75' and 'iqr_<variable>', one element per centile.
+    """
+    return centile_table(centile_order_statistics(price_percentiles, variables))
+
+
+def centile_order_statistics(price_percentiles: np.ndarray, variables: dict) -> dict:
+    """
+    :param price_percentiles: centile of price of each observation
+    :param variables: arrays of eps, ferr and cheps aligned with price_percentiles
+    :return: the centiles ('price_percentiles') and, for each variable, the two order statistics of each centile
+    that its median ('median': lower, upper) and quartiles ('P25' and 'P75': lower, upper, fraction) are
+    interpolated from, NaN for centiles without any value.
+    """
+    valid = ~np.isnan(price_percentiles)
+    centiles, codes = np.unique(price_percentiles[valid], return_inverse=True)
+
+    order_statistics = {'price_percentiles': centiles}
+    for column, values in variables.items():
+        values = values[valid].astype(np.float64)
+        present = ~np.isnan(values)
+        groups, values = codes[present], values[present]
+
+        # sort by centile first and by value within each centile
+        order = np.lexsort((values, groups))
+        values = values[order]
+        counts = np.bincount(groups, minlength=len(centiles))
+        starts = np.cumsum(counts) - counts
+
+        order_statistics[column] = {'median': _group_median(values, starts, counts),
+                                    'P25': _group_quantile(values, starts, counts, 0.25),
+                                    'P75': _group_quantile(values, starts, counts, 0.75)}
+
+    return order_statistics
+
+
+def centile_table(order_statistics: dict, bounds: dict = None) -> dict:
+    """
+    winsorizing is a monotone clip, so the order statistics of the winsorized values are the clipped
+    order statistics, and the table of winsorized values needs no sort of its own.
+
+    :param order_statistics: order statistics of each variable by centile (see centile_order_statistics)
+    :param bounds: winsorization bounds of each variable (see winsorization_bounds), the values are not winsorized
+    when there are none
+    :return: the same as centile_statistics (of the winsorized values)
+    """
+    statistics = {'price_percentiles': order_statistics['price_percentiles']}
+    for column, order in order_statistics.items():
+        if column == 'price_percentiles':
+            continue
+        clip = (lambda values: values) if bounds is None else \
+            (lambda values: np.minimum(np.maximum(values, bounds[column][0]), bounds[column][1]))
+
+        lower, upper = order['median']
+        statistics[column] = (clip(lower) + clip(upper)) / 2
+        for name in ['P25', 'P75']:
+            lower, upper, fraction = order[name]
+            lower, upper = clip(lower), clip(upper)
+            statistics[f'{column}_{name}'] = np.where(fraction == 0, lower, lower + (upper - lower) * fraction)
+        statistics[f'iqr_{column}'] = statistics[f'{column}_P75'] - statistics[f'{column}_P25']
+
+    return statistics
+
+
+def _group_quantile(values: np.ndarray, starts: np.ndarray, counts: np.ndarray, q: float) -> tuple:
+    """
+    :return: lower and upper values (NaN for empty groups) and the fraction between them of the
+    linearly interpolated quantile q of each group of the grouped and sorted values
+    """
+    empty = counts == 0
+    if not len(values):
+        return np.full(len(counts), np.nan), np.full(len(counts), np.nan), np.zeros(len(counts))
+    position = q * np.maximum(counts - 1, 0)
+    below = np.floor(position).astype(np.int64)
+    fraction = position - below
+    lower = values[np.where(empty, 0, starts + below)]
+    upper = values[np.where(empty, 0, starts + np.minimum(below + 1, np.maximum(counts - 1, 0)))]
+    return np.where(empty, np.nan, lower), np.where(empty, np.nan, upper), fraction
+
+
+def _group_median(values: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> tuple:
+    """
+    :return: the two middle values of each group of the grouped and sorted values (the same value if odd,
+    NaN for empty groups), the median is their mean
+    """
+    empty = counts == 0
+    if not len(values):
+        return np.full(len(counts), np.nan), np.full(len(counts), np.nan)
+    lower = values[np.where(empty, 0, starts + np.maximum(counts - 1, 0) // 2)]
+    upper = values[np.where(empty, 0, starts + counts // 2)]
+    return np.where(empty, np.nan, lower), np.where(empty, np.nan, upper)
+
+
+# edges of the 1-cent bins of the threshold histograms (Figures 5 to 7), from -20 to 20 cents
+HISTOGRAM_EDGES = np.arange(-20, 21)
+
+
+def threshold_bin(values: np.ndarray) -> np.ndarray:
+    """
+    bins values exactly like plotly bins the raw observations with xbins={'start': -20, 'size': 1, 'end': 20}:
+    each bin is [k, k + 1) cents, with plotly's 1e-9 rounding tolerance at the edges.
+
+    :return: 1-cent bin of each value from -20 to 20 cents, -1 for values outside of the bins (or missing)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    inside = (values >= HISTOGRAM_EDGES[0]) & (values <= HISTOGRAM_EDGES[-1])
+    bins = np.full(len(values), -1, dtype=np.int64)
+    bins[inside] = np.floor(values[inside] - HISTOGRAM_EDGES[0] + 1e-9)
+    bins[bins >= len(HISTOGRAM_EDGES) - 1] = -1
+    return bins
+
+
+def threshold_bins(variables: dict) -> dict:
+    """
+    Figures 5, 6 and 7 are drawn in turn from the same observations and each one drops
+    the observations missing its own variable, so ferr is only counted where cheps is present
+    and eps only where both cheps and ferr are present.
+
+    :return: 1-cent bin of each observation of cheps, ferr and eps, -1 where it is not counted
+    """
+    present = np.ones(len(variables['cheps']), dtype=bool)
+    bins = {}
+    for column in ['cheps', 'ferr', 'eps']:
+        present &= ~np.isnan(variables[column])
+        bins[column] = np.where(present, threshold_bin(variables[column]), -1)
+    return bins
+
+
+def threshold_histograms(variables: dict) -> dict:
+    """
+    :return: counts of cheps, ferr and eps in the 1-cent bins from -20 to 20 cents (see threshold_bins)
+    """
+    return {column: np.bincount(bins[bins >= 0], minlength=len(HISTOGRAM_EDGES) - 1)
+            for column, bins in threshold_bins(variables).items()}
+
+
+def window_variables(sample, rows: slice, use_winsorized: bool, limits: tuple = None) -> dict:
+    """
+    :param sample: the shared dataset.Sample
+    :param rows: observations of the selected years
+    :param use_winsorized: use the winsorized variables (over the whole sample) instead of the unwinsorized ones
+    :param limits: winsorize the unwinsorized variables of the rows at these limits instead
+    :return: eps, ferr and cheps of the rows (the shared sample itself is never modified)
+    """
+    if limits is not None:
+        return {column: clip_to_bounds(values[rows], winsorization_bounds(values[rows], limits))
+                for column, values in sample.variables(False).items()}
+    return {column: values[rows] for column, values in sample.variables(use_winsorized).items()}
+
+
+def figure_four_results(sample, years: tuple, use_winsorized: bool, limits: tuple = None) -> dict:
+    """
+    :param sample: the shared dataset.Sample
+    :param years: first and last year of the sample period
+    :param use_winsorized: use the winsorized variables instead of the unwinsorized ones
+    :param limits: winsorize the variables within the years at these limits instead
+    :return: centile statistics of Figure 4
+    """
+    # restrict the data range to the selected years and
+    # pick winsorized or unwinsorized variables (the shared sample itself is never modified)
+    with span('year_filter'):
+        rows = sample.years(*years)
+        variables = window_variables(sample, rows, use_winsorized, limits)
+
+    # create price percentiles after applying date restrictions and winsorization.
+    # first step to recreate Figure 4 of Degeorge et al., 1999
+    with span('price_percentiles', rows=rows.stop - rows.start):
+        price_percentiles = sample.price_percentiles(rows)
+
+    # median, P25, P75 and IQR of each variable by centile of price
+    with span('centile_statistics'):
+        return centile_statistics(price_percentiles, variables)
+
+
+def figure_four_order_statistics(sample, years: tuple) -> dict:
+    """
+    :param sample: the shared dataset.Sample
+    :param years: first and last year of the sample period
+    :return: order statistics of the unwinsorized variables by centile of price (see centile_order_statistics),
+    Figure 4 of any winsorization of the years is computed from them with centile_table
+    """
+    rows = sample.years(*years)
+    with span('price_percentiles', rows=rows.stop - rows.start):
+        price_percentiles = sample.price_percentiles(rows)
+    with span('centile_order_statistics'):
+        return centile_order_statistics(price_percentiles, window_variables(sample, rows, False))
+
+
+def histogram_results(sample, years: tuple, cutoff: tuple, use_winsorized: bool, cube=None,
+                      limits: tuple = None) -> dict:
+    """
+    :param sample: the shared dataset.Sample
+    :param years: first and last year of the sample period
+    :param cutoff: lowest and highest centile of price kept in the histograms
+    :param use_winsorized: use the winsorized variables instead of the unwinsorized ones
+    :param cube: histogram_cube.HistogramCube of sample, the rows are scanned when there is none
+    :param limits: winsorize the variables within the years at these limits instead (the rows are scanned)
+    :return: histogram counts of Figures 5 to 7
+    """
+    if cube is not None and limits is None:
+        with span('histogram_cube'):
+            return cube.histograms(sample, years, cutoff, use_winsorized)
+
+    with span('year_filter'):
+        rows = sample.years(*years)
+        variables = window_variables(sample, rows, use_winsorized, limits)
+    with span('price_percentiles', rows=rows.stop - rows.start):
+        price_percentiles = sample.price_percentiles(rows)
+
+    # TODO: Do we need vintage data to exactly replicate the study?
+
+    with span('histogram_filter'):
+        in_cutoff = (price_percentiles >= cutoff[0]) & (price_percentiles <= cutoff[1])
+        histogram_data = {column: values[in_cutoff] for column, values in variables.items()}
+        return threshold_histograms(histogram_data)
+
+
+def winsorize(values: np.ndarray, limits: tuple = (.01, .01)) -> np.ndarray:
+    """
+    same result as scipy.stats.mstats.winsorize(values, limits=limits), including its handling of missing
+    values (they sort last, so they are set to the upper bound when they fall within the top limit),
+    but the two bounds are found with np.partition in O(n) instead of a full sort.
+    used for the winsorized variables of the whole sample, see winsorization_bounds for those of a window.
+
+    :param values: values to winsorize
+    :param limits: fractions of the values to clip at the bottom and at the top
+    :return: winsorized copy of values
+    """
+    values = np.array(values, dtype=float)
+    lower_bound, upper_bound, winsorizes_missing = _scipy_winsorization_bounds(values, limits)
+    if np.isnan(lower_bound):
+        return np.full(len(values), np.nan)
+
+    values = np.minimum(np.maximum(values, lower_bound), upper_bound)
+    if winsorizes_missing:
+        values[np.isnan(values)] = upper_bound
+    return values
+
+
+def _scipy_winsorization_bounds(values: np.ndarray, limits: tuple) -> tuple:
+    """
+    :return: lower and upper bounds of winsorize(values, limits) (-inf and inf for a side that is not clipped,
+    NaN when every value is set to missing) and whether missing values are set to the upper bound
+    """
+    count = len(values)
+    low = int(limits[0] * count)
+    high = count - int(count * limits[1])
+    if not count or (not low and high == count):
+        return -np.inf, np.inf, False
+
+    # values at the two bounds of the sorted values (missing values sort last)
+    kth = sorted({min(low, count - 1), high - 1 if high else count - 1})
+    partitioned = np.partition(values, kth)
+    if not high:
+        # like scipy, every value is set to the last of the sorted values: the maximum, or missing if there is one
+        top = partitioned[-1]
+        return (np.nan, np.nan, True) if np.isnan(top) else (top, top, False)
+    lower_bound = partitioned[low] if low else -np.inf
+    if np.isnan(lower_bound):
+        return np.nan, np.nan, True
+    upper_bound = partitioned[high - 1] if high - 1 >= low else lower_bound
+    if high == count or np.isnan(upper_bound):
+        return lower_bound, np.inf, False
+    return lower_bound, upper_bound, bool(np.isnan(partitioned[high:]).any())
+
+
+def clip_to_bounds(values: np.ndarray, bounds: tuple) -> np.ndarray:
+    """
+    :param values: values to winsorize
+    :param bounds: lower and upper winsorization bounds (see winsorization_bounds), missing values stay missing
+    :return: winsorized copy of values
+    """
+    return np.minimum(np.maximum(np.asarray(values, dtype=np.float64), bounds[0]), bounds[1])
+
+
+def winsorization_bounds(values: np.ndarray, limits: tuple = (.01, .01)) -> tuple:
+    """
+    bounds of a winsorization of the non-missing values only: the limits are fractions of the values
+    that are present and missing values stay missing, so they neither hold the top limit open nor get
+    clipped into the distribution (the same as scipy.stats.mstats.winsorize of the non-missing values).
+
+    :param values: values to winsorize
+    :param limits: fractions of the non-missing values to clip at the bottom and at the top
+    :return: lower and upper bounds (-inf and inf for a side that is not clipped)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    present = values[~np.isnan(values)]
+    count = len(present)
+    low = int(limits[0] * count)
+    high = count - int(count * limits[1])
+    if not count or (not low and high == count):
+        return -np.inf, np.inf
+
+    partitioned = np.partition(present, sorted({min(low, count - 1), high - 1 if high else count - 1}))
+    if not high:
+        # every value is set to the last of the sorted values
+        return partitioned[-1], partitioned[-1]
+    lower_bound = partitioned[min(low, count - 1)] if low else -np.inf
+    upper_bound = np.inf if high == count else partitioned[high - 1] if high - 1 >= low else lower_bound
+    return lower_bound, upper_bound
+
+
+def window_winsorization(sample, years: tuple, limits: tuple) -> dict:
+    """
+    :param sample: the shared dataset.Sample
+    :param years: first and last year of the sample period
+    :param limits: fractions of the values of the years to clip at the bottom and at the top
+    :return: winsorization bounds (see winsorization_bounds) of the unwinsorized eps, ferr and cheps of the years
+    """
+    rows = sample.years(*years)
+    return {column: winsorization_bounds(values[rows], limits) for column, values in sample.variables(False).items()}
@@ -0,0 +1,142 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from analysis import figure_four_results, histogram_results
+from dataset import load_sample, save_sample
+from histogram_cube import HistogramCube, load_cube
+from synthetic import firms_for_rows, synthetic_ibes
+
+# rows of the sample at each size of the benchmark
+SIZES = [100_000, 1_000_000, 10_000_000]
+
+# years and price cutoff of the dashboard at start, and the whole period with every price
+WINDOWS = {'default': ((1984, 1996), (10, 90)), 'full': ((1984, 2018), (0, 100))}
+
+
+def load_pipeline():
+    """
+    :return: WRDS-Access.py as a module (its name is not importable), it creates its folders in the working directory
+    """
+    spec = importlib.util.spec_from_file_location('wrds_access', Path(__file__).with_name('WRDS-Access.py'))
+    module = importlib.util.module_from_spec(spec)
+    # registered so that the worker processes of prep_data can find its functions
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(function, repeat: int = 1) -> tuple:
+    """
+    :param function: function to call without arguments
+    :param repeat: number of calls
+    :return: best and median seconds of the calls, and the result of the last call
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return {'best': min(seconds), 'median': float(np.median(seconds)), 'repeat': repeat}, result
+
+
+def benchmark_size(rows: int, repeat: int, workers: int, seed: int) -> dict:
+    """
+    builds the sample from synthetic extracts in a temporary folder and times every step of the pipeline
+    and the computations of the dashboard, the same way WRDS-Access.py and main.py run them.
+
+    :param rows: rows of the sample (fiscal quarters)
+    :param repeat: number of calls of each dashboard computation
+    :param workers: number of processes of prep_data
+    :param seed: seed of the synthetic data
+    :return: sizes of the data and timings (seconds) of each step
+    """
+    timings = {}
+    folder = os.getcwd()
+    with tempfile.TemporaryDirectory() as work:
+        os.chdir(work)
+        try:
+            timings['generate'], (statsum, actpsum) = timed(lambda: synthetic_ibes(firms_for_rows(rows), seed=seed))
+            pipeline = load_pipeline()
+            statsum.to_pickle('dataPrep/ibes_statsum_USD.pkl.gz')
+            actpsum.to_pickle('dataPrep/ibes_actpsum_USD.pkl.gz')
+            extract_rows = {'statsum_epsus': len(statsum), 'actpsum_epsus': len(actpsum)}
+            del statsum, actpsum
+
+            timings['prep_data'], df = timed(lambda: pipeline.prep_data(workers=workers))
+            sample = df.drop(columns=pipeline.UNNEEDED_COLUMNS, errors='ignore')
+            del df
+            timings['save_sample'], _ = timed(lambda: save_sample(sample))
+            sample_rows = len(sample)
+            del sample
+
+            timings['load_data'], sample = timed(load_sample, repeat)
+            timings['build_cube'], cube = timed(lambda: HistogramCube.build(sample))
+            cube.save('input/histogram_cube')
+            timings['load_cube'], cube = timed(lambda: load_cube(sample), repeat)
+
+            for window, (years, cutoff) in WINDOWS.items():
+                timings[f'year_filter_{window}'], _ = timed(
+                    lambda: {column: values[sample.years(*years)]
+                             for column, values in sample.variables(False).items()}, repeat)
+                timings[f'centile_statistics_{window}'], _ = timed(
+                    lambda: figure_four_results(sample, years, False), repeat)
+                timings[f'histograms_scan_{window}'], _ = timed(
+                    lambda: histogram_results(sample, years, cutoff, False), repeat)
+                timings[f'histograms_cube_{window}'], _ = timed(
+                    lambda: histogram_results(sample, years, cutoff, False, cube), repeat)
+        finally:
+            os.chdir(folder)
+
+    return {'rows': rows, 'sample_rows': sample_rows, 'extract_rows': extract_rows, 'workers': workers,
+            'timings': timings}
+
+
+def commit() -> str:
+    """
+    :return: the commit of the working tree, None outside of a git repository
+    """
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the pipeline and the dashboard on synthetic I/B/E/S data.')
+    parser.add_argument('--rows', type=int, nargs='+', default=SIZES,
+                        help='rows of the sample of each benchmark (default: 100k, 1M and 10M)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of calls of each dashboard computation (the best and the median are kept)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes of prep_data')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic data')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file of the results, to compare them across commits')
+    args = parser.parse_args()
+
+    results = {'commit': commit(),
+               'created': pd.Timestamp.now(tz='UTC').isoformat(),
+               'platform': platform.platform(),
+               'processors': os.cpu_count(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'pandas': pd.__version__,
+               'benchmarks': []}
+
+    for rows in args.rows:
+        benchmark = benchmark_size(rows, args.repeat, args.workers, args.seed)
+        results['benchmarks'].append(benchmark)
+        print(f"{rows:>12,} rows: " + ', '.join(f"{step} {timing['best']:.3f}s"
+                                                for step, timing in benchmark['timings'].items()))
+
+    Path(args.output).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,199 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# the only columns of the sample that the dashboard reads
+SAMPLE_COLUMNS = ['year', 'price', 'eps_n', 'eps_w', 'ferr_n', 'ferr_w', 'cheps_n', 'cheps_w']
+
+# variables of Degeorge et al. (1999), each stored unwinsorized (_n) and winsorized (_w)
+VARIABLES = ['eps', 'ferr', 'cheps']
+
+# key of the schema metadata of the columnar file that holds its layout (the offset of every year)
+# and the fingerprint of its columns
+LAYOUT_KEY = b'degeorge.layout'
+
+
+class Sample:
+    """
+    Read-only column arrays of the sample for Degeorge et al. (1999).
+
+    The sample is loaded once per process and shared by every session and rerun,
+    so nothing here is ever written to: selections are returned as slices
+    and the winsorized/unwinsorized switch only picks which arrays to read.
+
+    Observations are stored sorted by year and by price within each year,
+    so a range of years is a contiguous slice and its prices are a run of pre-sorted years.
+    save_sample writes the file in that order, so the (memory-mapped) columns are kept as they are
+    and only a sample in any other order is sorted (and copied) here.
+    """
+
+    def __init__(self, columns: dict, year_offsets: np.ndarray = None, fingerprint: str = None):
+        """
+        :param columns: arrays of the sample
+        :param year_offsets: offsets of the years saved with the columns, which are then already sorted
+        :param fingerprint: fingerprint saved with the columns (see sample_fingerprint), computed when needed if None
+        """
+        if year_offsets is None and not sorted_by_year_and_price(columns['year'], columns['price']):
+            order = np.lexsort((columns['price'], columns['year']))
+            columns = {name: np.asarray(values)[order] for name, values in columns.items()}
+
+        self.columns = {}
+        for name, values in columns.items():
+            values = np.asarray(values).view()
+            values.flags.writeable = False
+            self.columns[name] = values
+
+        # offset of the first observation of every year, and one past the last year
+        self.first_year = int(self.year[0])
+        self.year_offsets = offsets_of_years(self.year) if year_offsets is None else np.asarray(year_offsets)
+        self._fingerprint = fingerprint
+
+    def __len__(self) -> int:
+        return len(self.year)
+
+    @property
+    def year(self) -> np.ndarray:
+        return self.columns['year']
+
+    @property
+    def price(self) -> np.ndarray:
+        return self.columns['price']
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        :return: hash of the columns, the results saved for a sample (cube, store) are only used for the same hash
+        """
+        if self._fingerprint is None:
+            self._fingerprint = sample_fingerprint(self.columns)
+        return self._fingerprint
+
+    def years(self, first: int, last: int) -> slice:
+        """
+        :return: slice of the observations from the first to the last year (inclusive)
+        """
+        first = min(max(first - self.first_year, 0), len(self.year_offsets) - 1)
+        last = min(max(last - self.first_year + 1, first), len(self.year_offsets) - 1)
+        return slice(int(self.year_offsets[first]), int(self.year_offsets[last]))
+
+    def price_percentiles(self, rows: slice) -> np.ndarray:
+        """
+        same as price.rank(pct=True).round(decimals=2) * 100 for the selected years,
+        but the ranking only merges the prices of the years, which are already sorted.
+
+        :return: centile of price of each observation in rows
+        """
+        return rank_percentiles(self.price[rows])
+
+    def variables(self, use_winsorized: bool) -> dict:
+        """
+        :return: arrays of eps, ferr and cheps, either winsorized or unwinsorized
+        """
+        suffix = 'w' if use_winsorized else 'n'
+        return {column: self.columns[f'{column}_{suffix}'] for column in VARIABLES}
+
+
+def sample_fingerprint(columns: dict) -> str:
+    """
+    :param columns: arrays of the sample, sorted by year and price
+    :return: hash of the names, dtypes and values of the columns the dashboard reads
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for name in SAMPLE_COLUMNS:
+        values = np.ascontiguousarray(columns[name])
+        digest.update(f'{name}:{values.dtype.str}:'.encode())
+        digest.update(values)
+    return digest.hexdigest()
+
+
+def sorted_by_year_and_price(year: np.ndarray, price: np.ndarray) -> bool:
+    """
+    :return: whether the observations are in the order of np.lexsort((price, year)), missing prices last
+    """
+    year_steps = np.diff(year)
+    if (year_steps < 0).any():
+        return False
+    earlier, later = price[:-1], price[1:]
+    return not ((year_steps == 0) & ((later < earlier) | (np.isnan(earlier) & ~np.isnan(later)))).any()
+
+
+def offsets_of_years(year: np.ndarray) -> np.ndarray:
+    """
+    :param year: sorted years of the observations
+    :return: offset of the first observation of every year, and one past the last year
+    """
+    first_year = int(year[0])
+    return np.searchsorted(year, np.arange(first_year, int(year[-1]) + 2))
+
+
+def rank_percentiles(prices: np.ndarray, below: int = 0, count: int = None) -> np.ndarray:
+    """
+    centiles of price, the same as rank(pct=True).round(decimals=2) * 100 (ties share their average rank).
+
+    :param prices: prices to rank, a stable sort merges any pre-sorted runs (e.g. years) in them
+    :param below: number of prices of the whole window that are lower than every one of prices
+    :param count: number of (non-missing) prices in the whole window, defaults to the prices given
+    :return: centile of each price within the window
+    """
+    present = np.count_nonzero(~np.isnan(prices))
+    count = present if count is None else count
+
+    # a stable sort (timsort) finds the pre-sorted runs and merges them
+    order = np.argsort(prices, kind='stable')[:present]
+    sorted_prices = prices[order]
+
+    # tied prices share their average (1-based) rank
+    changes = np.flatnonzero(sorted_prices[1:] != sorted_prices[:-1]) + 1
+    starts = below + np.concatenate(([0], changes))
+    stops = below + np.concatenate((changes, [present]))
+    ranks = np.repeat((starts + stops + 1) / 2, stops - starts)
+
+    percentiles = np.full(len(prices), np.nan)
+    percentiles[order] = np.round(ranks / count, decimals=2) * 100
+    return percentiles
+
+
+def save_sample(df: pd.DataFrame, folder: str = 'input') -> None:
+    """
+    saves the sample as an uncompressed Arrow IPC (feather) file in the layout Sample uses:
+    sorted by year and by price within each year, in one record batch (so every column maps to one array)
+    and with the offsets of the years and the fingerprint of the columns in its metadata,
+    so loading it neither sorts, copies nor hashes anything.
+
+    :param df: the sample built by WRDS-Access.py
+    :param folder: folder of the sample
+    """
+    df = df.reset_index()
+    df = df.iloc[np.lexsort((df['price'].to_numpy(), df['year'].to_numpy()))].reset_index(drop=True)
+    layout = {'year_offsets': offsets_of_years(df['year'].to_numpy()).tolist(),
+              'fingerprint': sample_fingerprint({column: df[column].to_numpy() for column in SAMPLE_COLUMNS})}
+
+    # missing values are stored as NaN rather than as nulls, so the float columns also map without a copy
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for number, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type):
+            table = table.set_column(number, field, pa.array(df[field.name].to_numpy()))
+    table = table.replace_schema_metadata({**table.schema.metadata, LAYOUT_KEY: json.dumps(layout)})
+    feather.write_feather(table, Path(folder, 'data.feather'), compression='uncompressed', chunksize=max(len(df), 1))
+
+
+def load_sample(folder: str = 'input') -> Sample:
+    """
+    :return: the sample with only the columns the dashboard needs.
+    the columnar (Arrow IPC) file is memory-mapped, the gzip pickle is kept as a fallback
+    for samples built before the columnar format existed.
+    """
+    if Path(folder, 'data.feather').exists():
+        table = feather.read_table(Path(folder, 'data.feather'), columns=SAMPLE_COLUMNS, memory_map=True)
+        metadata = table.schema.metadata or {}
+        layout = json.loads(metadata[LAYOUT_KEY]) if LAYOUT_KEY in metadata else {}
+        return Sample({column: table.column(column).to_numpy() for column in SAMPLE_COLUMNS},
+                      layout.get('year_offsets'), layout.get('fingerprint'))
+
+    df = pd.read_pickle(Path(folder, 'data.pkl.gz'))
+    return Sample({column: df[column].to_numpy() for column in SAMPLE_COLUMNS})
@@ -0,0 +1,74 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from analysis import HISTOGRAM_EDGES
+
+# bin of the histograms that starts at zero cents, the threshold of Figures 5 to 7
+THRESHOLD_BIN = int(np.flatnonzero(HISTOGRAM_EDGES == 0)[0])
+
+# bootstrap replicates drawn at once, each block is one (replicates x bins) array of counts
+BOOTSTRAP_BLOCK = 10_000
+
+
+def smoothness_statistics(counts: np.ndarray) -> np.ndarray:
+    """
+    standardized difference of Degeorge et al. (1999) of each bin: the change in frequency from the previous bin,
+    less the mean change of the two neighbouring bins, over the standard deviation of the changes in the histogram.
+    a smooth distribution has no large tau, a jump at the threshold has a large tau at zero.
+
+    :param counts: histogram counts, bins on the last axis (any leading axes, e.g. bootstrap replicates)
+    :return: tau of each bin, NaN for the first two and the last bin (they lack a neighbouring change)
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frequencies = counts / counts.sum(axis=-1, keepdims=True)
+        changes = np.diff(frequencies, axis=-1)
+        tau = np.full(counts.shape, np.nan)
+        tau[..., 2:-1] = (changes[..., 1:-1] - (changes[..., :-2] + changes[..., 2:]) / 2) / \
+            changes.std(axis=-1, ddof=1, keepdims=True)
+    return tau
+
+
+def bootstrap_smoothness(counts: np.ndarray, replicates: int = 2000, level: float = .95, seed: int = 0,
+                         workers: int = 1) -> dict:
+    """
+    bootstrap of the standardized differences: resampling the observations of the histogram with replacement
+    is the same as drawing its bin counts from a multinomial distribution, so each block of replicates is one
+    draw of a (replicates x bins) array and no observation (or replicate) is ever looped over.
+
+    :param counts: histogram counts of the observations
+    :param replicates: number of bootstrap replicates
+    :param level: coverage of the confidence intervals
+    :param seed: seed of the resampling, the replicates are the same whatever the number of workers
+    :param workers: number of processes drawing the blocks of replicates
+    :return: 'tau' of each bin, bounds of its percentile confidence interval ('lower', 'upper'), and 'replicates'
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    blocks = [min(BOOTSTRAP_BLOCK, replicates - start) for start in range(0, replicates, BOOTSTRAP_BLOCK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            taus = list(pool.map(_bootstrap_block, repeat(counts), blocks, seeds))
+    else:
+        taus = [_bootstrap_block(counts, block, block_seed) for block, block_seed in zip(blocks, seeds)]
+
+    # percentile intervals of the bins that have a statistic
+    lower, upper = np.full(len(counts), np.nan), np.full(len(counts), np.nan)
+    if counts.sum() and replicates:
+        lower[2:-1], upper[2:-1] = np.nanpercentile(np.concatenate(taus)[:, 2:-1],
+                                                    [(1 - level) / 2 * 100, (1 + level) / 2 * 100], axis=0)
+    return {'tau': smoothness_statistics(counts), 'lower': lower, 'upper': upper, 'replicates': replicates}
+
+
+def _bootstrap_block(counts: np.ndarray, replicates: int, seed: np.random.SeedSequence) -> np.ndarray:
+    """
+    :return: standardized differences of replicates resampled histograms
+    """
+    total = counts.sum()
+    if not total:
+        return np.full((replicates, len(counts)), np.nan)
+    resampled = np.random.default_rng(seed).multinomial(total, counts / total, size=replicates)
+    return smoothness_statistics(resampled)
@@ -0,0 +1,203 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from analysis import (HISTOGRAM_EDGES, centile_statistics, centile_table, clip_to_bounds,
+                      figure_four_order_statistics, figure_four_results, histogram_results, threshold_bins,
+                      threshold_histograms, window_winsorization)
+from dataset import VARIABLES, load_sample
+from discontinuity import bootstrap_smoothness
+from profiling import span
+from results_cache import ResultsCache
+from results_store import CENTILES, STATISTICS, ResultsStore
+
+
+class StudyEngine:
+    """
+    Everything the dashboard computes, without any of its widgets, so the results of the study can be
+    computed (and served) outside of a browser session.
+
+    Results are answered from the precomputed store when there is one, otherwise from the histogram cube
+    and the sample, and are kept in the results cache either way.
+
+    The variables can also be winsorized within the selected years at any limits: the bounds are found in O(n)
+    and Figure 4 is clipped from the order statistics of the years, which are kept for every other limit.
+    """
+
+    def __init__(self, sample, cube=None, store=None, cache: ResultsCache = None):
+        self.sample = sample
+        self.cube = cube
+        self.store = store
+        self.cache = ResultsCache() if cache is None else cache
+
+    def figure_four(self, years: tuple, use_winsorized: bool, limits: tuple = None) -> dict:
+        """
+        :param limits: winsorize the variables within the years at these limits instead of use_winsorized
+        :return: centile statistics of Figure 4
+        """
+        if limits is not None:
+            return self.cache.get(('figure_four', years, limits), lambda: self._winsorized_figure_four(years, limits))
+        return self.cache.get(('figure_four', years, use_winsorized),
+                              lambda: figure_four_results(self.sample, years, use_winsorized) if self.store is None
+                              else self.store.figure_four(years, use_winsorized))
+
+    def histograms(self, years: tuple, cutoff: tuple, use_winsorized: bool, limits: tuple = None) -> dict:
+        """
+        :param limits: winsorize the variables within the years at these limits instead of use_winsorized
+        :return: histogram counts of Figures 5 to 7
+        """
+        if limits is not None:
+            bounds = self.winsorization(years, limits)
+            if all(lower < HISTOGRAM_EDGES[0] and upper > HISTOGRAM_EDGES[-1] for lower, upper in bounds.values()):
+                # the winsorization only moves values that are outside of the histograms
+                return self.histograms(years, cutoff, False)
+            return self.cache.get(('histograms', years, cutoff, limits),
+                                  lambda: self._winsorized_histograms(years, cutoff, bounds))
+
+        return self.cache.get(('histograms', years, cutoff, use_winsorized),
+                              lambda: histogram_results(self.sample, years, cutoff, use_winsorized, self.cube)
+                              if self.store is None else self.store.histograms(years, cutoff, use_winsorized))
+
+    def discontinuity_tests(self, years: tuple, cutoff: tuple, use_winsorized: bool, limits: tuple = None,
+                            replicates: int = 2000, workers: int = 1) -> dict:
+        """
+        :param replicates: number of bootstrap replicates of each histogram
+        :param workers: number of processes drawing the replicates
+        :return: standardized differences of the histograms of Figures 5 to 7 (see discontinuity.bootstrap_smoothness)
+        """
+        histograms = self.histograms(years, cutoff, use_winsorized, limits)
+        return self.cache.get(('discontinuity', years, cutoff, use_winsorized, limits, replicates),
+                              lambda: {column: bootstrap_smoothness(counts, replicates, workers=workers)
+                                       for column, counts in histograms.items()})
+
+    def winsorization(self, years: tuple, limits: tuple) -> dict:
+        """
+        :return: winsorization bounds of each variable within the years (see analysis.winsorization_bounds)
+        """
+        return self.cache.get(('winsorization', years, limits),
+                              lambda: window_winsorization(self.sample, years, limits))
+
+    def _winsorized_figure_four(self, years: tuple, limits: tuple) -> dict:
+        """
+        :return: centile statistics of Figure 4 of the variables winsorized within the years
+        """
+        bounds = self.winsorization(years, limits)
+        order_statistics = self.cache.get(('order_statistics', years),
+                                          lambda: figure_four_order_statistics(self.sample, years))
+        return centile_table(order_statistics, bounds)
+
+    def _winsorized_histograms(self, years: tuple, cutoff: tuple, bounds: dict) -> dict:
+        """
+        :return: histogram counts of Figures 5 to 7 of the variables winsorized within the years at bounds
+        """
+        rows = self.sample.years(*years)
+        centile = self.cache.get(('centiles', years), lambda: window_centiles(self.sample, years))
+        # the last element is for the observations without a price
+        kept = np.append((CENTILES >= cutoff[0]) & (CENTILES <= cutoff[1]), False)[centile]
+        return threshold_histograms({column: clip_to_bounds(values[rows][kept], bounds[column])
+                                     for column, values in self.sample.variables(False).items()})
+
+
+def window_centiles(sample, years: tuple) -> np.ndarray:
+    """
+    :return: centile of price (0 to 100, -1 without a price) of every observation of the years, compactly
+    """
+    percentiles = sample.price_percentiles(sample.years(*years))
+    return np.where(np.isnan(percentiles), -1, np.rint(percentiles)).astype(np.int8)
+
+
+# the sample and the histogram bins of its observations, loaded once by every worker process
+_worker = {}
+
+
+def _start_worker(folder: str) -> None:
+    """
+    loads the (memory-mapped) sample and bins every observation once, every window of the process reuses them
+    """
+    sample = load_sample(folder)
+    _worker['sample'] = sample
+    _worker['bins'] = {suffix: threshold_bins(sample.variables(suffix == 'w')) for suffix in ['n', 'w']}
+
+
+def sweep_first_year(first: int) -> tuple:
+    """
+    computes the results of every window of years that starts in the first-th year of the sample.
+    the centiles of price of each window are ranked once and shared by both winsorizations and every cutoff.
+
+    :param first: index of the first year of the windows
+    :return: centiles present, statistics of Figure 4 and histogram counts by centile of each window
+    """
+    sample, bins = _worker['sample'], _worker['bins']
+    years = len(sample.year_offsets) - 1
+    windows = years - first
+    centiles = np.zeros((windows, len(CENTILES)), dtype=bool)
+    statistics = {suffix: np.full((windows, len(STATISTICS), len(CENTILES)), np.nan) for suffix in ['n', 'w']}
+    histograms = {suffix: np.zeros((windows, len(CENTILES), len(VARIABLES), len(HISTOGRAM_EDGES) - 1),
+                                   dtype=np.uint32) for suffix in ['n', 'w']}
+
+    for window in range(windows):
+        rows = sample.years(sample.first_year + first, sample.first_year + first + window)
+        percentiles = sample.price_percentiles(rows)
+        valid = ~np.isnan(percentiles)
+        centile = np.rint(percentiles[valid]).astype(np.int64)
+        centiles[window] = np.bincount(centile, minlength=len(CENTILES)) > 0
+
+        for suffix in ['n', 'w']:
+            variables = {column: values[rows] for column, values in sample.variables(suffix == 'w').items()}
+            table = centile_statistics(percentiles, variables)
+            present = np.rint(table['price_percentiles']).astype(np.int64)
+            for number, name in enumerate(STATISTICS):
+                statistics[suffix][window, number, present] = table[name]
+
+            for number, column in enumerate(VARIABLES):
+                value_bins = bins[suffix][column][rows][valid]
+                counted = value_bins >= 0
+                cells = centile[counted] * (len(HISTOGRAM_EDGES) - 1) + value_bins[counted]
+                histograms[suffix][window, :, number] = np.bincount(
+                    cells, minlength=len(CENTILES) * (len(HISTOGRAM_EDGES) - 1)).reshape(len(CENTILES), -1)
+
+    return centiles, statistics, histograms
+
+
+def build_store(folder: str = 'input', workers: int = 1) -> ResultsStore:
+    """
+    sweeps every range of years (and with it every price cutoff and both winsorizations) of the sample.
+
+    :param folder: folder of the sample
+    :param workers: number of processes, each one sweeps the windows of a first year at a time
+    :return: the store of the results of the sample
+    """
+    sample = load_sample(folder)
+    years = len(sample.year_offsets) - 1
+
+    # the longest windows (the earliest first years) are sent out first
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker, initargs=(folder,)) as pool:
+            sweeps = list(pool.map(sweep_first_year, range(years)))
+    else:
+        _start_worker(folder)
+        sweeps = [sweep_first_year(first) for first in range(years)]
+
+    centiles, statistics, histograms = zip(*sweeps)
+    return ResultsStore(sample.first_year, years, sample.fingerprint, np.concatenate(centiles),
+                        {suffix: np.concatenate([table[suffix] for table in statistics]) for suffix in ['n', 'w']},
+                        {suffix: np.concatenate([counts[suffix] for counts in histograms]) for suffix in ['n', 'w']})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the results of Degeorge et al. (1999) for every '
+                                                 'range of years, price cutoff and winsorization.')
+    parser.add_argument('--folder', default='input',
+                        help='folder of the sample, the store is saved there in results_store')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes sweeping the ranges of years')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with span('build_store', workers=args.workers):
+        store = build_store(args.folder, args.workers)
+        store.save(Path(args.folder, 'results_store'))
+    print(f'{len(store.centiles):,} ranges of years swept in {time.perf_counter() - start:.1f}s')
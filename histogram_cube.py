@@ -0,0 +1,163 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from analysis import HISTOGRAM_EDGES, threshold_bins, threshold_histograms
+from dataset import VARIABLES, rank_percentiles
+
+# number of price buckets (quantiles of the price of the whole sample) of the cube
+PRICE_BUCKETS = 256
+
+
+class HistogramCube:
+    """
+    Prefix sums of the threshold histograms (Figures 5 to 7) by year and price bucket.
+
+    counts[suffix][variable][y, k] holds the 1-cent bin counts of every observation before year index y
+    and below price bucket k, so the histogram of any block of years and buckets is four lookups.
+    A centile cutoff is answered from the buckets that lie entirely within the cutoff, plus a scan of
+    the rows of the (at most few) buckets the cutoff falls into, so the counts are always exact.
+    """
+
+    def __init__(self, edges: np.ndarray, first_year: int, rows: np.ndarray, counts: dict, fingerprint: str):
+        self.edges = edges
+        self.first_year = first_year
+        self.rows = rows
+        self.counts = counts
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, sample, buckets: int = PRICE_BUCKETS) -> 'HistogramCube':
+        """
+        :param sample: the dataset.Sample the cube answers for
+        :param buckets: number of price buckets, more buckets mean fewer rows to scan at the cutoffs
+        :return: the cube of sample
+        """
+        price = sample.price
+        present = ~np.isnan(price)
+        edges = np.unique(np.quantile(price[present], np.linspace(0, 1, buckets + 1)))
+        buckets = max(len(edges) - 1, 1)
+
+        years = len(sample.year_offsets) - 1
+        cells = (sample.year.astype(np.int64) - sample.first_year) * buckets + \
+            np.clip(np.searchsorted(edges, price, side='right') - 1, 0, buckets - 1)
+        cells = cells[present]
+
+        rows = np.bincount(cells, minlength=years * buckets).reshape(years, buckets)
+
+        bins = len(HISTOGRAM_EDGES) - 1
+        counts = {}
+        for suffix in ['n', 'w']:
+            # the same missing-value rules as threshold_histograms
+            value_bins = threshold_bins({column: sample.columns[f'{column}_{suffix}'][present]
+                                         for column in VARIABLES})
+            counts[suffix] = {}
+            for column in VARIABLES:
+                counted = value_bins[column] >= 0
+                cell_bins = cells[counted] * bins + value_bins[column][counted]
+                cube = np.bincount(cell_bins, minlength=years * buckets * bins).reshape(years, buckets, bins)
+                counts[suffix][column] = _prefix_sums(cube)
+
+        return cls(edges, sample.first_year, _prefix_sums(rows), counts, sample.fingerprint)
+
+    def save(self, path) -> None:
+        """
+        saves the cube as one .npy file per array in the folder path, so every process can memory-map them
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        Path(path, 'cube.json').unlink(missing_ok=True)
+        np.save(Path(path, 'edges.npy'), self.edges)
+        np.save(Path(path, 'rows.npy'), self.rows)
+        for suffix, variables in self.counts.items():
+            for column, cube in variables.items():
+                np.save(Path(path, f'counts_{suffix}_{column}.npy'), cube)
+        # written last, so a partly saved cube never matches a sample
+        Path(path, 'cube.json').write_text(json.dumps({'first_year': self.first_year, 'fingerprint': self.fingerprint}))
+
+    @classmethod
+    def load(cls, path) -> 'HistogramCube':
+        """
+        :return: the cube saved in the folder path, its arrays are memory-mapped (read-only)
+        """
+        header = json.loads(Path(path, 'cube.json').read_text())
+        counts = {suffix: {column: np.load(Path(path, f'counts_{suffix}_{column}.npy'), mmap_mode='r')
+                           for column in VARIABLES} for suffix in ['n', 'w']}
+        return cls(np.load(Path(path, 'edges.npy')), header['first_year'],
+                   np.load(Path(path, 'rows.npy'), mmap_mode='r'), counts, header['fingerprint'])
+
+    def matches(self, sample) -> bool:
+        """
+        :return: whether the cube was built from sample (the same rows, not only the same size and years)
+        """
+        return self.fingerprint == sample.fingerprint
+
+    def histograms(self, sample, years: tuple, cutoff: tuple, use_winsorized: bool) -> dict:
+        """
+        same as threshold_histograms of the observations of the years whose price centile is within cutoff.
+
+        :return: counts of cheps, ferr and eps in the 1-cent bins from -20 to 20 cents
+        """
+        first = min(max(years[0] - self.first_year, 0), self.rows.shape[0] - 1)
+        last = min(max(years[1] - self.first_year + 1, first), self.rows.shape[0] - 1)
+        counts = self.counts['w' if use_winsorized else 'n']
+
+        # observations of the window in each price bucket, and below each bucket
+        window = self.rows[last] - self.rows[first]
+        bucket_rows = np.diff(window)
+        total = int(window[-1])
+        below = window[:-1]
+
+        # bounds on the centiles of the observations of each bucket
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lowest = np.round((below + 1) / total, decimals=2) * 100
+            highest = np.round((below + bucket_rows) / total, decimals=2) * 100
+        occupied = bucket_rows > 0
+        within = occupied & (lowest >= cutoff[0]) & (highest <= cutoff[1])
+        straddling = occupied & ~within & (highest >= cutoff[0]) & (lowest <= cutoff[1])
+
+        # centiles increase with price, so the buckets within the cutoff are contiguous
+        histograms = {column: np.zeros(len(HISTOGRAM_EDGES) - 1, dtype=np.int64) for column in VARIABLES}
+        if within.any():
+            start, stop = np.flatnonzero(within)[[0, -1]] + [0, 1]
+            for column in VARIABLES:
+                histograms[column] += counts[column][last, stop] - counts[column][first, stop] - \
+                    counts[column][last, start] + counts[column][first, start]
+
+        # scan the rows of the buckets the cutoffs fall into
+        for bucket in np.flatnonzero(straddling):
+            positions = np.concatenate([np.arange(sample.year_offsets[year] + self.rows[year + 1, bucket] -
+                                                  self.rows[year, bucket],
+                                                  sample.year_offsets[year] + self.rows[year + 1, bucket + 1] -
+                                                  self.rows[year, bucket + 1])
+                                        for year in range(first, last)])
+            percentiles = rank_percentiles(sample.price[positions], below=int(below[bucket]), count=total)
+            positions = positions[(percentiles >= cutoff[0]) & (percentiles <= cutoff[1])]
+            scanned = threshold_histograms({column: values[positions] for column, values in
+                                            sample.variables(use_winsorized).items()})
+            for column in VARIABLES:
+                histograms[column] += scanned[column]
+
+        return histograms
+
+
+def _prefix_sums(counts: np.ndarray) -> np.ndarray:
+    """
+    :return: counts summed over every earlier year and price bucket, with a leading row and column of zeros
+    (32-bit, a sum never exceeds the number of observations)
+    """
+    sums = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1) + counts.shape[2:], dtype=np.int32)
+    sums[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+    return sums
+
+
+def load_cube(sample, folder: str = 'input'):
+    """
+    :return: the cube saved at prep time if it was built from sample, otherwise None
+    """
+    path = Path(folder, 'histogram_cube')
+    if not Path(path, 'cube.json').exists():
+        return None
+    cube = HistogramCube.load(path)
+    return cube if cube.matches(sample) else None
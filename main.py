@@ -1,13 +1,47 @@
-import pandas as pd
+import numpy as np
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
 
+from analysis import HISTOGRAM_EDGES
+from dataset import Sample, load_sample
+from discontinuity import THRESHOLD_BIN
+from engine import StudyEngine
+from histogram_cube import HistogramCube, load_cube
+from profiling import MEMORY, Trace, span, start_trace
+from results_store import ResultsStore, load_store
 
-# load the main data and cache it.
-@st.cache_data()
-def load_data() -> pd.DataFrame:
-    return pd.read_pickle('input/data.pkl.gz')
+
+# load the main data once per process and share it (read-only) across sessions and reruns.
+@st.cache_resource()
+def load_data() -> Sample:
+    return load_sample()
+
+
+# load the prefix-sum cube of the histograms saved with the sample, if there is one.
+@st.cache_resource()
+def load_histogram_cube() -> HistogramCube:
+    return load_cube(load_data())
+
+
+# load the results precomputed by engine.py for every parameter of the study, if there are some.
+@st.cache_resource()
+def load_results_store() -> ResultsStore:
+    return load_store(load_data())
+
+
+# computations (and cached results) of the study, shared by every session of this process.
+# the store answers every histogram, so the cube is only loaded without one
+@st.cache_resource()
+def study_engine() -> StudyEngine:
+    store = load_results_store()
+    return StudyEngine(load_data(), load_histogram_cube() if store is None else None, store)
+
+
+# centers and hover labels of the 1-cent bins of Figures 5 to 7,
+# the histograms are binned on the server and only the counts are sent to the browser
+BIN_CENTERS = HISTOGRAM_EDGES[:-1] + 0.5
+BIN_LABELS = [f'{start} to {start + 1}' for start in HISTOGRAM_EDGES[:-1]]
 
 
 # preparation of figure 4 of the paper
@@ -86,25 +120,25 @@ def figure_four_presentation():
 
 
 # preparation of Figure 5 of the paper
-def figure_five_presentation(figure_five_data: pd.DataFrame) -> None:
-    figure_five_data.dropna(axis=0, subset=['cheps'], inplace=True)
-    figure_five_data = figure_five_data[(figure_five_data['cheps'] >= -20) & (figure_five_data['cheps'] <= 20)]
+def figure_five_presentation(figure_five_counts: np.ndarray) -> None:
     st.header("Figure 5")
-    figure_five = go.Figure(data=[go.Histogram(x=figure_five_data['cheps'],
-                                               hoverinfo='all',
-                                               name='',
-                                               hovertemplate="<b>∆EPS range:</b> %{x} cents<br>"
-                                                             "<b>Freq:</b> %{y:,}",
-                                               showlegend=False,
-                                               xbins={'start': -20, 'size': 1, 'end': 20},
-                                               marker=dict(color='#C189C5',
-                                                           line=dict(color='#fff', width=0.1),
-                                                           opacity=(.5, .5, .5, .5, .5, .5, .5, .5, .5, .5,
-                                                                    .5, .5, .5, .5, .5, .5, .5, .5, .5, .5, 1)
-                                                           ),
-                                               hoverlabel=dict(bgcolor='#fafafa'),
-                                               selected=dict(marker={'opacity': 1}),
-                                               unselected=dict(marker={'opacity': 0.7}))],
+    figure_five = go.Figure(data=[go.Bar(x=BIN_CENTERS,
+                                         y=figure_five_counts,
+                                         width=1,
+                                         customdata=BIN_LABELS,
+                                         hoverinfo='all',
+                                         name='',
+                                         hovertemplate="<b>∆EPS range:</b> %{customdata} cents<br>"
+                                                       "<b>Freq:</b> %{y:,}",
+                                         showlegend=False,
+                                         marker=dict(color='#C189C5',
+                                                     line=dict(color='#fff', width=0.1),
+                                                     opacity=(.5, .5, .5, .5, .5, .5, .5, .5, .5, .5,
+                                                              .5, .5, .5, .5, .5, .5, .5, .5, .5, .5, 1)
+                                                     ),
+                                         hoverlabel=dict(bgcolor='#fafafa'),
+                                         selected=dict(marker={'opacity': 1}),
+                                         unselected=dict(marker={'opacity': 0.7}))],
                             layout=dict(title=dict(text='<b>Histogram of change in EPS '
                                                         '(∆EPS = EPS<sub>t</sub> - EPS<sub>t-4</sub>):<br>'
                                                         'exploring the threshold of "sustain recent performance."</b>',
@@ -123,25 +157,25 @@ def figure_five_presentation(figure_five_data: pd.DataFrame) -> None:
 
 
 # preparation of Figure 6 of the paper
-def figure_six_presentation(figure_six_data: pd.DataFrame) -> None:
-    figure_six_data.dropna(axis=0, subset=['ferr'], inplace=True)
-    figure_six_data = figure_six_data[(figure_six_data['ferr'] >= -20) & (figure_six_data['ferr'] <= 20)]
+def figure_six_presentation(figure_six_counts: np.ndarray) -> None:
     st.header("Figure 6")
-    figure_six = go.Figure(data=[go.Histogram(x=figure_six_data['ferr'],
-                                              hoverinfo='all',
-                                              name='',
-                                              hovertemplate="<b>Forecast Error range:</b> %{x} cents<br>"
-                                                            "<b>Freq:</b> %{y:,}",
-                                              showlegend=False,
-                                              xbins={'start': -20, 'size': 1, 'end': 20},
-                                              marker=dict(color='#C5C189',
-                                                          line=dict(color='#fff', width=0.1),
-                                                          opacity=(.5, .5, .5, .5, .5, .5, .5, .5, .5, .5,
-                                                                   .5, .5, .5, .5, .5, .5, .5, .5, .5, .5, 1)
-                                                          ),
-                                              hoverlabel=dict(bgcolor='#fafafa'),
-                                              selected=dict(marker={'opacity': 1}),
-                                              unselected=dict(marker={'opacity': 0.7}))],
+    figure_six = go.Figure(data=[go.Bar(x=BIN_CENTERS,
+                                        y=figure_six_counts,
+                                        width=1,
+                                        customdata=BIN_LABELS,
+                                        hoverinfo='all',
+                                        name='',
+                                        hovertemplate="<b>Forecast Error range:</b> %{customdata} cents<br>"
+                                                      "<b>Freq:</b> %{y:,}",
+                                        showlegend=False,
+                                        marker=dict(color='#C5C189',
+                                                    line=dict(color='#fff', width=0.1),
+                                                    opacity=(.5, .5, .5, .5, .5, .5, .5, .5, .5, .5,
+                                                             .5, .5, .5, .5, .5, .5, .5, .5, .5, .5, 1)
+                                                    ),
+                                        hoverlabel=dict(bgcolor='#fafafa'),
+                                        selected=dict(marker={'opacity': 1}),
+                                        unselected=dict(marker={'opacity': 0.7}))],
                            layout=dict(title=dict(text="<b>Histogram of forecast error for earnings per share:<br>"
                                                        "exploring the threshold of meeting analysts’ expectations.</b>",
                                                   font=dict(family='Helvetica', size=12),
@@ -159,25 +193,25 @@ def figure_six_presentation(figure_six_data: pd.DataFrame) -> None:
 
 
 # preparation of Figure 7 of the paper
-def figure_seven_presentation(figure_seven_data: pd.DataFrame) -> None:
-    figure_seven_data.dropna(axis=0, subset=['eps'], inplace=True)
-    figure_seven_data = figure_seven_data[(figure_seven_data['eps'] >= -20) & (figure_seven_data['eps'] <= 20)]
+def figure_seven_presentation(figure_seven_counts: np.ndarray) -> None:
     st.header("Figure 7")
-    figure_seven = go.Figure(data=[go.Histogram(x=figure_seven_data['eps'],
-                                                hoverinfo='all',
-                                                name='',
-                                                hovertemplate="<b>Forecast Error range:</b> %{x} cents<br>"
-                                                              "<b>Freq:</b> %{y:,}",
-                                                showlegend=False,
-                                                xbins={'start': -20, 'size': 1, 'end': 20},
-                                                marker=dict(color='#89C5C1',
-                                                            line=dict(color='#fff', width=0.1),
-                                                            opacity=(.5, .5, .5, .5, .5, .5, .5, .5, .5, .5,
-                                                                     .5, .5, .5, .5, .5, .5, .5, .5, .5, .5, 1)
-                                                            ),
-                                                hoverlabel=dict(bgcolor='#fafafa'),
-                                                selected=dict(marker={'opacity': 1}),
-                                                unselected=dict(marker={'opacity': 0.7}))],
+    figure_seven = go.Figure(data=[go.Bar(x=BIN_CENTERS,
+                                          y=figure_seven_counts,
+                                          width=1,
+                                          customdata=BIN_LABELS,
+                                          hoverinfo='all',
+                                          name='',
+                                          hovertemplate="<b>Forecast Error range:</b> %{customdata} cents<br>"
+                                                        "<b>Freq:</b> %{y:,}",
+                                          showlegend=False,
+                                          marker=dict(color='#89C5C1',
+                                                      line=dict(color='#fff', width=0.1),
+                                                      opacity=(.5, .5, .5, .5, .5, .5, .5, .5, .5, .5,
+                                                               .5, .5, .5, .5, .5, .5, .5, .5, .5, .5, 1)
+                                                      ),
+                                          hoverlabel=dict(bgcolor='#fafafa'),
+                                          selected=dict(marker={'opacity': 1}),
+                                          unselected=dict(marker={'opacity': 0.7}))],
                              layout=dict(title=dict(text='<b>Histogram of EPS:<br>'
                                                          'exploring the threshold of "positive/zero profit."</b>',
                                                     font=dict(family='Helvetica', size=12),
@@ -194,6 +228,65 @@ def figure_seven_presentation(figure_seven_data: pd.DataFrame) -> None:
     st.plotly_chart(figure_seven)
 
 
+# standardized difference of Degeorge et al. (1999) at the zero threshold, with its bootstrap confidence interval
+def discontinuity_presentation(test: dict) -> None:
+    tau, lower, upper = test['tau'][THRESHOLD_BIN], test['lower'][THRESHOLD_BIN], test['upper'][THRESHOLD_BIN]
+    if np.isnan(tau):
+        st.caption("Discontinuity at zero: τ is not defined, "
+                   "the histogram has no observations or no variation between bins.")
+        return
+    # rank of the threshold among the bins that have a statistic
+    others = test['tau'][~np.isnan(test['tau'])]
+    st.caption(f"Discontinuity at zero: τ = {tau:.2f} (95% bootstrap interval {lower:.2f} to {upper:.2f}, "
+               f"{test['replicates']:,} replicates), ranked {int(np.sum(others > tau)) + 1} of {len(others)} bins "
+               f"from the largest. A smooth distribution has no large τ.")
+
+
+# waterfall of the stages of this rerun and hit rate of the results cache (only when profiling is on)
+def performance_presentation(trace: Trace) -> None:
+    with st.expander(label='Performance', expanded=False):
+        spans = trace.spans
+        hover = [f"{record['duration'] * 1000:,.1f} ms" +
+                 ('' if not MEMORY else '<br>memory not measured (another session was running)'
+                  if record.get('memory_concurrent') else
+                  f"<br>{record['memory_peak'] / 2 ** 20:,.1f} MB peak, "
+                  f"{record['memory_delta'] / 2 ** 20:+,.1f} MB kept")
+                 for record in spans]
+        waterfall = go.Figure(data=[go.Bar(y=np.arange(len(spans)),
+                                           x=[record['duration'] * 1000 for record in spans],
+                                           base=[record['start'] * 1000 for record in spans],
+                                           orientation='h',
+                                           customdata=hover,
+                                           name='',
+                                           hovertemplate='%{customdata}',
+                                           marker=dict(color='#89C5C1'))],
+                              layout=dict(title=dict(text='<b>Stages of this rerun</b>',
+                                                     font=dict(family='Helvetica', size=12),
+                                                     x=0.5,
+                                                     xanchor='center'),
+                                          height=max(250, 25 * len(spans)),
+                                          plot_bgcolor='#fafafa'))
+        waterfall.update_xaxes(title='Milliseconds since the start of the rerun',
+                               showgrid=True, gridwidth=1, gridcolor='#cfcaca')
+        waterfall.update_yaxes(tickvals=np.arange(len(spans)),
+                               ticktext=['\u2003' * record['depth'] + record['span'] for record in spans],
+                               autorange='reversed')
+        st.plotly_chart(waterfall)
+        if any(record.get('memory_concurrent') for record in spans):
+            # tracemalloc counts the allocations of the whole process, not of this session
+            st.caption('The memory of some stages was not measured, another session was running at the same time. '
+                       'Memory profiling is only exact with a single session.')
+
+        engine = study_engine()
+        stats = engine.cache.stats()
+        # the cube is not loaded when the store answers every histogram
+        cube = 'loaded' if engine.cube is not None else 'not needed' if engine.store is not None else 'not available'
+        st.write(f"Results cache: {stats['hit_rate']:.0%} of {stats['hits'] + stats['misses']:,} lookups were hits, "
+                 f"{stats['entries']:,} results kept ({stats['nbytes'] / 2 ** 20:,.1f} MB). "
+                 f"Results store: {'loaded' if engine.store is not None else 'not available'}. "
+                 f"Histogram cube: {cube}.")
+
+
 if __name__ == "__main__":
     # paper information
     st.header("Earnings Management to Exceed Thresholds")
@@ -201,8 +294,12 @@ if __name__ == "__main__":
     st.caption("*The Journal of Business*, Vol. 72, No. 1 (January 1999), pp. 1-33")
     st.caption("[Link to the original article](https://www.jstor.org/stable/10.1086/209601)")
 
+    # timing (and memory) spans of every stage of this rerun, when profiling is on
+    trace = start_trace('rerun')
+
     # open the data
-    df = load_data()
+    with span('load_data'):
+        sample = load_data()
 
     # save user selection of the years to include in the replication
     with st.expander(label='Expand to change the parameters of the study', expanded=True):
@@ -218,8 +315,8 @@ if __name__ == "__main__":
                  'that overlap with the original study (1984 to 1996).\n\n'
                  'Try expanding the sample period using the slider below!')
         st.session_state.selected_date = st.slider(label='Range of years:',
-                                                   min_value=min(df['year']),
-                                                   max_value=max(df['year']),
+                                                   min_value=int(sample.year.min()),
+                                                   max_value=int(sample.year.max()),
                                                    value=[1984, 1996])
 
         # user chooses the cutoff for extreme prices
@@ -242,54 +339,62 @@ if __name__ == "__main__":
                                                      value=[10, 90])
 
         # use winsorized or unwinsorized values based on the preference of the user
+        # (the choice below is kept under its key before it is drawn, so it can disable this one)
         st.session_state.use_winsorized = st.checkbox(label='Use Winsorized Variables (1% , 99%)',
-                                                      value=False)
-
-    # restrict the data range to the selected years
-    df = df[(df['year'] >= st.session_state.selected_date[0]) & (df['year'] <= st.session_state.selected_date[1])]
-    df.reset_index(inplace=True)
-
-    if st.session_state.use_winsorized:
-        for column in ['eps', 'ferr', 'cheps']:
-            df[f'{column}'] = df[f'{column}_w']
-
-    else:
-        for column in ['eps', 'ferr', 'cheps']:
-            df[f'{column}'] = df[f'{column}_n']
-
-    # create price percentiles after applying date restrictions and winsorization.
-    # first step to recreate Figure 4 of Degeorge et al., 1999
-    df['price_percentiles'] = df['price'].rank(pct=True).round(decimals=2) * 100
-
-    medians_by_PCT = df.groupby('price_percentiles',
-                                as_index=False).median(['eps', 'ferr', 'cheps'])
-
-    p25_by_PCT = df[['price_percentiles', 'eps', 'ferr', 'cheps']].groupby('price_percentiles',
-                                                                           as_index=False).quantile(q=0.25)
-
-    p75_by_PCT = df[['price_percentiles', 'eps', 'ferr', 'cheps']].groupby('price_percentiles',
-                                                                           as_index=False).quantile(q=0.75)
-
-    pct_data = medians_by_PCT.join(p25_by_PCT, rsuffix='_P25')
-    pct_data = pct_data.join(p75_by_PCT, rsuffix='_P75')
-
-    pct_data['iqr_eps'] = (pct_data['eps_P75'] - pct_data['eps_P25'])
-    pct_data['iqr_ferr'] = (pct_data['ferr_P75'] - pct_data['ferr_P25'])
-    pct_data['iqr_cheps'] = (pct_data['cheps_P75'] - pct_data['cheps_P25'])
-
-    # TODO: Do we need vintage data to exactly replicate the study?
-
-    histogram_data: pd.DataFrame = df[(df['price_percentiles'] >= st.session_state.selected_cutoff[0]) &
-                                      (df['price_percentiles'] <= st.session_state.selected_cutoff[1])]
+                                                      value=False,
+                                                      disabled=st.session_state.get('winsorize_years', False))
+
+        # or winsorize the variables within the selected years only, at the percentiles the user chooses
+        st.checkbox(label='Winsorize within the selected years instead', value=False, key='winsorize_years')
+        st.session_state.winsorization_percentiles = st.slider(label='Winsorization percentiles:',
+                                                               min_value=0.0,
+                                                               max_value=100.0,
+                                                               value=[1.0, 99.0],
+                                                               step=0.5,
+                                                               disabled=not st.session_state.winsorize_years)
+
+        # replicates of the bootstrap of the discontinuity test of Figures 5 to 7
+        st.session_state.bootstrap_replicates = st.number_input(label='Bootstrap replicates of the '
+                                                                      'discontinuity tests:',
+                                                                min_value=100,
+                                                                max_value=100_000,
+                                                                value=2000,
+                                                                step=100)
+
+    # centile statistics and histogram counts only depend on the parameters of the study,
+    # so they are shared by every session through the engine (and precomputed if there is a results store)
+    years = tuple(st.session_state.selected_date)
+    cutoff = tuple(st.session_state.selected_cutoff)
+    lowest, highest = st.session_state.winsorization_percentiles
+    limits = (round(min(lowest, 99.5) / 100, 4), round(1 - max(highest, 0.5) / 100, 4)) \
+        if st.session_state.winsorize_years else None
+    with span('figure_four_results'):
+        pct_data = study_engine().figure_four(years, st.session_state.use_winsorized, limits)
+    with span('histogram_results'):
+        histograms = study_engine().histograms(years, cutoff, st.session_state.use_winsorized, limits)
+    with span('discontinuity_tests', replicates=st.session_state.bootstrap_replicates):
+        tests = study_engine().discontinuity_tests(years, cutoff, st.session_state.use_winsorized, limits,
+                                                   int(st.session_state.bootstrap_replicates))
 
     # present figure four
-    figure_four_presentation()
+    with span('figure_four_presentation'):
+        figure_four_presentation()
 
     # present figure five
-    figure_five_presentation(histogram_data)
+    with span('figure_five_presentation'):
+        figure_five_presentation(histograms['cheps'])
+        discontinuity_presentation(tests['cheps'])
 
     # present figure six
-    figure_six_presentation(histogram_data)
+    with span('figure_six_presentation'):
+        figure_six_presentation(histograms['ferr'])
+        discontinuity_presentation(tests['ferr'])
 
     # present figure seven
-    figure_seven_presentation(histogram_data)
+    with span('figure_seven_presentation'):
+        figure_seven_presentation(histograms['eps'])
+        discontinuity_presentation(tests['eps'])
+
+    # present the stages of this rerun
+    if trace is not None:
+        performance_presentation(trace)
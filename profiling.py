@@ -0,0 +1,129 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# DEGEORGE_PROFILE=time records the duration of every span, DEGEORGE_PROFILE=memory also its allocations
+# (only while one run is active, e.g. a single dashboard session).
+# profiling is off by default, a span is then one shared no-op context manager
+MODE = os.environ.get('DEGEORGE_PROFILE', '').strip().lower()
+ENABLED = MODE in ['1', 'true', 'time', 'memory']
+MEMORY = MODE == 'memory'
+
+# every finished span is logged as one JSON object
+logger = logging.getLogger('degeorge.profile')
+if ENABLED:
+    logger.setLevel(logging.INFO)
+    if not logger.hasHandlers():
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+if MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+_DISABLED = contextlib.nullcontext()
+_local = threading.local()
+
+# traces with an open span. tracemalloc is process-wide, so memory is only measured while a single trace
+# is active: the spans of concurrent sessions are logged with memory_concurrent instead of their memory
+_active = set()
+_active_lock = threading.Lock()
+
+
+class Trace:
+    """
+    Spans of one run (a rerun of the dashboard or a build of the sample) in the order they started.
+
+    Each thread has its own trace, as Streamlit runs every session in its own thread.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.spans = []
+        # traced memory at the start of every open span and the highest since (None when it is not measured)
+        self.memory = []
+        # number of times another trace became active alongside this one
+        self.overlaps = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self.memory)
+
+
+def start_trace(name: str) -> Trace:
+    """
+    :return: a new trace that the spans of this thread are added to, None when profiling is off
+    """
+    if not ENABLED:
+        return None
+    _local.trace = Trace(name)
+    return _local.trace
+
+
+def span(name: str, **fields):
+    """
+    context manager that times (and with DEGEORGE_PROFILE=memory, measures the allocations of) a stage.
+
+    :param name: name of the stage
+    :param fields: any other values to log with the span
+    :return: the span
+    """
+    if not ENABLED:
+        return _DISABLED
+    return _span(name, fields)
+
+
+@contextlib.contextmanager
+def _span(name: str, fields: dict):
+    trace = getattr(_local, 'trace', None) or start_trace('process')
+    record = {'trace': trace.name, 'span': name, 'depth': trace.depth, **fields}
+    trace.spans.append(record)
+
+    with _active_lock:
+        if not trace.depth:
+            _active.add(trace)
+            if len(_active) > 1:
+                for active in _active:
+                    active.overlaps += 1
+        alone = len(_active) == 1
+    overlaps = trace.overlaps
+
+    if MEMORY and alone:
+        current, peak = tracemalloc.get_traced_memory()
+        if trace.memory and trace.memory[-1] is not None:
+            trace.memory[-1][1] = max(trace.memory[-1][1], peak)
+        tracemalloc.reset_peak()
+        trace.memory.append([current, current])
+    else:
+        trace.memory.append(None)
+
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        end = time.perf_counter()
+        record['start'] = start - trace.origin
+        record['duration'] = end - start
+
+        started = trace.memory.pop()
+        with _active_lock:
+            if not trace.depth:
+                _active.discard(trace)
+
+        if MEMORY and (started is None or trace.overlaps != overlaps):
+            # another trace reset (or added to) the process-wide peak during the span
+            record['memory_concurrent'] = True
+        elif MEMORY:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(started[1], peak)
+            record['memory_delta'] = current - started[0]
+            record['memory_peak'] = peak - started[0]
+            tracemalloc.reset_peak()
+            if trace.memory and trace.memory[-1] is not None:
+                trace.memory[-1][1] = max(trace.memory[-1][1], peak)
+
+        logger.info(json.dumps(record))
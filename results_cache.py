@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ResultsCache:
+    """
+    Least-recently-used cache of the derived results (centile table and histogram counts)
+    keyed on the study parameters: (years, cutoff, use_winsorized).
+
+    One instance is shared by every session, so it is guarded by a lock and the cached arrays are read-only.
+    Entries are evicted, oldest first, once the cached arrays take more than max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, key: tuple, compute):
+        """
+        :param key: hashable study parameters
+        :param compute: called without arguments to build the result on a miss
+        :return: the cached (or freshly computed) result for key
+        """
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+
+        result = compute()
+        size = _freeze(result)
+
+        with self._lock:
+            if key not in self._results:
+                self._results[key] = result
+                self._sizes[key] = size
+                self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self._results) > 1:
+                evicted, _ = self._results.popitem(last=False)
+                self.nbytes -= self._sizes.pop(evicted)
+        return result
+
+    def stats(self) -> dict:
+        """
+        :return: hits, misses, hit rate, number of entries and bytes held
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._results),
+                'nbytes': self.nbytes}
+
+
+def _freeze(result) -> int:
+    """
+    makes every array in result (nested in tuples, lists and dicts) read-only.
+
+    :return: bytes taken by the arrays
+    """
+    if isinstance(result, np.ndarray):
+        result.flags.writeable = False
+        return result.nbytes
+    if isinstance(result, dict):
+        return sum(_freeze(value) for value in result.values())
+    if isinstance(result, (tuple, list)):
+        return sum(_freeze(value) for value in result)
+    return 0
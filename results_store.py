@@ -0,0 +1,115 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+from analysis import HISTOGRAM_EDGES
+from dataset import VARIABLES
+
+# centile of price of the observations ranked k-th hundredth, as rank_percentiles computes it
+CENTILES = np.arange(101) / 100 * 100
+
+# statistics of Figure 4 of each variable, in the order they are stored
+STATISTICS = [name for column in VARIABLES for name in
+              [column, f'{column}_P25', f'{column}_P75', f'iqr_{column}']]
+
+
+class ResultsStore:
+    """
+    Results of Figures 4 to 7 for every range of years of the sample, precomputed by engine.py.
+
+    Windows (first year <= last year) are numbered first year by first year.
+    For each window and winsorization, the store keeps the statistics of Figure 4 (tables) and the histogram
+    counts of Figures 5 to 7 (counts) of each centile of price, so any price cutoff is answered by adding up
+    the counts of the centiles it keeps, exactly as if the rows were filtered.
+    """
+
+    def __init__(self, first_year: int, years: int, fingerprint: str, centiles: np.ndarray, tables: dict,
+                 counts: dict):
+        self.first_year = first_year
+        self.years = years
+        self.fingerprint = fingerprint
+        self.centiles = centiles
+        self.tables = tables
+        self.counts = counts
+
+    def save(self, path) -> None:
+        """
+        saves the store as one .npy file per array in the folder path, so every process can memory-map them
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        Path(path, 'store.json').unlink(missing_ok=True)
+        np.save(Path(path, 'centiles.npy'), self.centiles)
+        for kind, results in [('tables', self.tables), ('counts', self.counts)]:
+            for suffix in ['n', 'w']:
+                np.save(Path(path, f'{kind}_{suffix}.npy'), results[suffix])
+        # written last, so a partly saved store never matches a sample
+        Path(path, 'store.json').write_text(json.dumps({'first_year': self.first_year, 'years': self.years,
+                                                        'fingerprint': self.fingerprint}))
+
+    @classmethod
+    def load(cls, path) -> 'ResultsStore':
+        """
+        :return: the store saved in the folder path, its arrays are memory-mapped (read-only),
+        so a process only reads the windows it is asked for
+        """
+        header = json.loads(Path(path, 'store.json').read_text())
+        arrays = {name: np.load(Path(path, f'{name}.npy'), mmap_mode='r')
+                  for name in ['centiles', 'tables_n', 'tables_w', 'counts_n', 'counts_w']}
+        return cls(header['first_year'], header['years'], header['fingerprint'], arrays['centiles'],
+                   {suffix: arrays[f'tables_{suffix}'] for suffix in ['n', 'w']},
+                   {suffix: arrays[f'counts_{suffix}'] for suffix in ['n', 'w']})
+
+    def matches(self, sample) -> bool:
+        """
+        :return: whether the store was computed from sample (the same rows, not only the same size and years)
+        """
+        return self.fingerprint == sample.fingerprint
+
+    def window(self, years: tuple) -> int:
+        """
+        :return: number of the window of years (clamped to the years of the sample, like Sample.years),
+        None when it has no year of the sample (an inverted range, or one before or after the sample)
+        """
+        first = min(max(years[0] - self.first_year, 0), self.years)
+        stop = min(max(years[1] - self.first_year + 1, first), self.years)
+        if stop == first:
+            return None
+        return first * self.years - first * (first - 1) // 2 + stop - 1 - first
+
+    def figure_four(self, years: tuple, use_winsorized: bool) -> dict:
+        """
+        :return: centile statistics of Figure 4, the same as analysis.figure_four_results
+        """
+        window = self.window(years)
+        if window is None:
+            return {'price_percentiles': CENTILES[:0], **{name: np.empty(0) for name in STATISTICS}}
+        present = self.centiles[window]
+        statistics = self.tables['w' if use_winsorized else 'n'][window]
+        results = {'price_percentiles': CENTILES[present]}
+        for number, name in enumerate(STATISTICS):
+            results[name] = statistics[number, present]
+        return results
+
+    def histograms(self, years: tuple, cutoff: tuple, use_winsorized: bool) -> dict:
+        """
+        :return: histogram counts of Figures 5 to 7, the same as analysis.histogram_results
+        """
+        window = self.window(years)
+        if window is None:
+            return {column: np.zeros(len(HISTOGRAM_EDGES) - 1, dtype=np.int64) for column in VARIABLES}
+        kept = (CENTILES >= cutoff[0]) & (CENTILES <= cutoff[1])
+        counts = self.counts['w' if use_winsorized else 'n'][window][kept].sum(axis=0, dtype=np.int64)
+        return {column: counts[number] for number, column in enumerate(VARIABLES)}
+
+
+def load_store(sample, folder: str = 'input'):
+    """
+    :return: the store saved by engine.py if it was computed from sample, otherwise None
+    """
+    path = Path(folder, 'results_store')
+    if not Path(path, 'store.json').exists():
+        return None
+    store = ResultsStore.load(path)
+    return store if store.matches(sample) else None
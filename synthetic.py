@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+# share of the fiscal quarters a firm misses in the I/B/E/S summary history
+MISSING_QUARTERS = .03
+
+# fiscal years mostly end in December, the others end one or two months earlier in the quarter
+FISCAL_YEAR_ENDS = {0: .7, 1: .15, 2: .15}
+
+
+def expected_quarters(first_year: int = 1984, last_year: int = 2017) -> float:
+    """
+    :return: expected number of fiscal quarters (rows of the sample) of a synthetic firm
+    """
+    quarters = (last_year - first_year + 1) * 4
+    return float(np.mean((4 + quarters - np.arange(quarters - 3)) / 2)) * (1 - MISSING_QUARTERS)
+
+
+def firms_for_rows(rows: int, first_year: int = 1984, last_year: int = 2017) -> int:
+    """
+    :return: number of synthetic firms whose sample has about rows observations
+    """
+    return max(int(np.ceil(rows / expected_quarters(first_year, last_year))), 1)
+
+
+def synthetic_ibes(firms: int = 1000, first_year: int = 1984, last_year: int = 2017, seed: int = 0) -> tuple:
+    """
+    I/B/E/S-like extracts to measure the pipeline without WRDS, with the columns prep_data uses
+    (STATSUM_COLUMNS and ACTPSUM_COLUMNS of WRDS-Access.py) and the dtypes of compact_extract.
+
+    every firm is covered for a run of consecutive fiscal quarters (a few are missing), the quarters end
+    at month ends three months apart and the actuals are announced 20 to 45 days later (45 to 90 days for
+    the fourth quarter). the consensus (meanest) is computed on the third Thursday of each of the three
+    months before the announcement and converges to the actual. EPS follows a seasonal random walk
+    around a firm level, with some of the small losses and decreases managed up to zero or a cent.
+
+    :param firms: number of firms (tickers)
+    :param first_year: first calendar year of the fiscal quarters
+    :param last_year: last calendar year of the fiscal quarters
+    :param seed: seed of the random generator
+    :return: statsum_epsus and actpsum_epsus shaped frames
+    """
+    rng = np.random.default_rng(seed)
+    quarters = (last_year - first_year + 1) * 4
+
+    # run of fiscal quarters of every firm
+    starts = rng.integers(0, quarters - 3, firms)
+    lengths = rng.integers(4, quarters - starts + 1)
+    firm = np.repeat(np.arange(firms), lengths)
+    quarter = starts[firm] + np.arange(len(firm)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    fiscal_quarter = quarter % 4
+
+    # quarter ends, and the announcement of the actuals
+    year_end = rng.choice(list(FISCAL_YEAR_ENDS), firms, p=list(FISCAL_YEAR_ENDS.values()))
+    months = np.datetime64(f'{first_year}-01', 'M') + (3 * quarter + 2 - year_end[firm])
+    fpedats = (months + 1).astype('datetime64[D]') - 1
+    lag = np.where(fiscal_quarter == 3, rng.integers(45, 91, len(firm)), rng.integers(20, 46, len(firm)))
+    anndats = fpedats + lag
+
+    # EPS in dollars: firm level, seasonal effect and a random walk within the firm
+    level = rng.normal(.25, .35, firms)
+    season = rng.normal(0, .04, (firms, 4))
+    walk = np.cumsum(rng.normal(0, .05, len(firm)))
+    walk -= np.repeat(walk[np.cumsum(lengths) - lengths], lengths)
+    actual = np.round(level[firm] + season[firm, fiscal_quarter] + walk, 2)
+
+    # some of the small losses and the small decreases are managed up to zero or a cent
+    previous = np.concatenate(([np.nan], actual[:-1]))
+    previous[np.cumsum(lengths) - lengths] = np.nan
+    small_miss = ((actual < 0) & (actual >= -.03)) | ((actual < previous) & (actual >= previous - .02))
+    managed = small_miss & (rng.random(len(firm)) < .3)
+    actual[managed] = np.where(actual[managed] < 0, 0, previous[managed]) + \
+        rng.integers(0, 2, np.count_nonzero(managed)) / 100
+
+    kept = rng.random(len(firm)) >= MISSING_QUARTERS
+    firm, fpedats, anndats, actual = firm[kept], fpedats[kept], anndats[kept], actual[kept]
+
+    # consensus on the third Thursday of each of the three months before the announcement
+    months_before = np.tile(np.arange(1, 4), len(firm))
+    statpers = _third_thursday(np.repeat(anndats.astype('datetime64[M]'), 3) - months_before)
+    error = rng.normal(0, .02, len(statpers)) * months_before + rng.normal(.005, .01, len(statpers))
+    statsum = pd.DataFrame({'ticker': np.repeat(firm, 3),
+                            'statpers': statpers,
+                            'fpedats': np.repeat(fpedats, 3),
+                            'anndats_act': np.repeat(anndats, 3),
+                            'actual': np.repeat(actual, 3),
+                            'meanest': np.round(np.repeat(actual, 3) + error, 4)})
+
+    # one price per firm and consensus date, a random walk around the firm level
+    actpsum = statsum[['ticker', 'statpers']].drop_duplicates().sort_values(['ticker', 'statpers'])
+    counts = np.bincount(actpsum['ticker'], minlength=firms)
+    walk = np.cumsum(rng.normal(0, .08, len(actpsum)))
+    walk -= np.repeat(walk[np.cumsum(counts) - counts], counts)
+    price = np.exp(rng.normal(3, .9, firms))[actpsum['ticker']] * np.exp(walk)
+    actpsum = actpsum.assign(price=np.round(np.maximum(price, .05), 2))
+
+    tickers = pd.Categorical.from_codes(np.arange(firms), categories=[f'{number:06X}' for number in range(firms)])
+    for df in [statsum, actpsum]:
+        df['ticker'] = pd.Categorical.from_codes(df['ticker'], dtype=tickers.dtype)
+        df['statpers'] = df['statpers'].astype('datetime64[ns]')
+    for date in ['fpedats', 'anndats_act']:
+        statsum[date] = statsum[date].astype('datetime64[ns]')
+
+    return statsum.reset_index(drop=True), actpsum.reset_index(drop=True)
+
+
+def _third_thursday(months: np.ndarray) -> np.ndarray:
+    """
+    :return: the third Thursday of each month (the I/B/E/S statistical period)
+    """
+    first_day = months.astype('datetime64[D]')
+    # 1970-01-01 was a Thursday
+    return first_day + (-first_day.astype(np.int64)) % 7 + 14